@@ -3,14 +3,17 @@ The exercises and classes are configured in json/yaml.
 Courses are listed in the database.
 '''
 from __future__ import annotations
+from collections import OrderedDict
 import copy
 from dataclasses import dataclass
 from enum import Enum
+from functools import lru_cache
 import json
 import logging
 import os
 from pathlib import Path
 import time
+import threading
 from typing import Any, Dict, Iterable, Optional, List, Tuple, Union
 
 from django.conf import settings
@@ -31,6 +34,33 @@ INDEX = "index"
 
 LOGGER = logging.getLogger('main')
 
+# Configs used by this process keyed by CourseConfig.cache_key, least recently used first. These are
+# checked before the Django cache, so that a valid config doesn't need to be fetched and unpickled on
+# every request. The same CourseConfig object is returned to every caller and thread, so the configs
+# returned by CourseConfig.get and get_many must not be modified (use copy.deepcopy if needed).
+_LOCAL_CONFIG_CACHE: "OrderedDict[str, CourseConfig]" = OrderedDict()
+_LOCAL_CONFIG_CACHE_SIZE = 256
+_LOCAL_CONFIG_CACHE_LOCK = threading.Lock()
+
+
+def _get_local_config(cache_key: str) -> Optional["CourseConfig"]:
+    """Returns the config from the process-local cache if it is there and still valid"""
+    with _LOCAL_CONFIG_CACHE_LOCK:
+        config = _LOCAL_CONFIG_CACHE.get(cache_key)
+        if config is not None:
+            _LOCAL_CONFIG_CACHE.move_to_end(cache_key)
+    if config is not None and config.is_valid():
+        return config
+    return None
+
+
+def _set_local_config(cache_key: str, config: "CourseConfig") -> None:
+    with _LOCAL_CONFIG_CACHE_LOCK:
+        _LOCAL_CONFIG_CACHE[cache_key] = config
+        _LOCAL_CONFIG_CACHE.move_to_end(cache_key)
+        if len(_LOCAL_CONFIG_CACHE) > _LOCAL_CONFIG_CACHE_SIZE:
+            _LOCAL_CONFIG_CACHE.popitem(last=False)
+
 
 def _type_dict(dict_item: Dict[str, Any], dict_types: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
     '''
@@ -51,8 +81,20 @@ def _type_dict(dict_item: Dict[str, Any], dict_types: Dict[str, Dict[str, Any]])
     return base
 
 
+@lru_cache(maxsize=256)
+def _read_meta(path: str, mtime_ns: int, size: int) -> Dict[str,str]:
+    """<mtime_ns> and <size> are only used as a part of the cache key so that a changed file is read again"""
+    return read_meta(path)
+
+
 def load_meta(course_dir: Union[str, Path]) -> Dict[str,str]:
-    return read_meta(os.path.join(course_dir, META))
+    path = os.path.join(course_dir, META)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {}
+    # Copy so that the cached dict cannot be modified
+    return dict(_read_meta(path, st.st_mtime_ns, st.st_size))
 
 
 class ConfigSource(Enum):
@@ -144,7 +186,8 @@ class CourseConfig:
 
         config_file_info = exercise.config_file_info(self.dir, self.grader_config_dir)
         if config_file_info:
-            self._config_obj = ExerciseConfig.load(
+            # Not stored in the exercise: the config may be shared (see _LOCAL_CONFIG_CACHE)
+            return ExerciseConfig.load(
                 exercise_key,
                 *config_file_info,
                 self.lang,
@@ -206,6 +249,7 @@ class CourseConfig:
 
         destination_key = CourseConfig.cache_key(config.key, destination)
         cache.set(destination_key, config)
+        _set_local_config(destination_key, config)
 
     @staticmethod
     def relative_path_to(key: str = "", *paths: str) -> str:
@@ -277,7 +321,14 @@ class CourseConfig:
     @staticmethod
     def get_many(course_keys: Iterable[str], source: ConfigSource = ConfigSource.PUBLISH) -> Tuple[List[CourseConfig], List[str]]:
         course_keys = list(course_keys)
-        config_map = cache.get_many(CourseConfig.cache_key(key, source) for key in course_keys)
+        cache_keys = [CourseConfig.cache_key(key, source) for key in course_keys]
+        # Only fetch the configs from the Django cache that this process doesn't already have
+        config_map = {}
+        for cache_key in cache_keys:
+            config = _get_local_config(cache_key)
+            if config is not None:
+                config_map[cache_key] = config
+        config_map.update(cache.get_many(k for k in cache_keys if k not in config_map))
 
         loaded_configs = {}
         configs = []
@@ -286,6 +337,7 @@ class CourseConfig:
             cache_key = CourseConfig.cache_key(key, source)
             if cache_key in config_map and config_map[cache_key].is_valid():
                 config = config_map[cache_key]
+                _set_local_config(cache_key, config)
             else:
                 try:
                     config = CourseConfig.load(key, source)
@@ -300,6 +352,7 @@ class CourseConfig:
                     continue
                 else:
                     loaded_configs[cache_key] = config
+                    _set_local_config(cache_key, config)
 
             configs.append(config)
             warnings = validation_warning_str(config)
@@ -348,6 +401,11 @@ class CourseConfig:
         '''
         cache_key = CourseConfig.cache_key(course_key, source)
 
+        # Try the version already in this process.
+        config = _get_local_config(cache_key)
+        if config is not None:
+            return config
+
         # Try cached version.
         try:
             config = cache.get(cache_key)
@@ -355,11 +413,13 @@ class CourseConfig:
             LOGGER.error(f"Failed to get config from cache: {e}")
         else:
             if config and config.is_valid():
+                _set_local_config(cache_key, config)
                 return config
 
         LOGGER.debug('Loading course "%s"' % (course_key))
 
         config = CourseConfig.load(course_key, source)
+        _set_local_config(cache_key, config)
 
         try:
             cache.set(cache_key, config)
@@ -385,7 +445,8 @@ class CourseConfig:
         meta = load_meta(course_dir)
         f = ConfigParser.get_config(os.path.join(CourseConfig._conf_dir(course_dir, meta), INDEX))
 
-        t, data = ConfigParser.parse(f)
+        # parse_with_stat reuses the parsed data if the index file hasn't changed since it was last parsed
+        t, data = ConfigParser.parse_with_stat(f, os.stat(f))
         if data is None:
             raise ConfigError('Failed to parse configuration file "%s"' % (f))
         elif not isinstance(data, dict):
@@ -474,8 +535,8 @@ class CourseConfig:
 
     @staticmethod
     def read_defaults(key: str, source: ConfigSource = ConfigSource.PUBLISH) -> dict:
-        with open(CourseConfig.defaults_path(key, source)) as file:
-            return json.load(file)
+        with open(CourseConfig.defaults_path(key, source), "rb") as file:
+            return json.loads(file.read())
 
     @staticmethod
     def _conf_dir(course_dir, meta):
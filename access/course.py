@@ -1,8 +1,12 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from pathlib import Path
-from typing import Any, Dict, Generator, List, Literal, Optional, Set, Tuple, Type, TypeVar, Union
+from typing import Any, Dict, Generator, Iterable, List, Literal, Optional, Set, Tuple, Type, TypeVar, Union
 from datetime import date, datetime, timedelta
 import os
+import re
+import threading
 import time
 
 from django.conf import settings
@@ -20,16 +24,47 @@ from .parser import ConfigParser
 
 LOGGER = logging.getLogger('main')
 
+FileSignature = Tuple[Tuple[str, int, int], ...]
+
+# Loaded exercise configs keyed by (absolute config file path, exercise key, default language).
+# The values are (signature, config) tuples where the signature contains the (path, st_mtime_ns, st_size)
+# of the config file and every file it includes. A config is reparsed only if the signature changes.
+_EXERCISE_CFG_CACHE: "OrderedDict[Tuple[str, str, str], Tuple[FileSignature, ExerciseConfig]]" = OrderedDict()
+_EXERCISE_CFG_CACHE_SIZE = 4096
+_EXERCISE_CFG_CACHE_LOCK = threading.Lock()
+
+
+def _file_signature(paths: Iterable[str]) -> Optional[FileSignature]:
+    """Returns the (path, st_mtime_ns, st_size) tuples of the given files or None if any of them can't be stat'd"""
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        signature.append((path, st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+_END_OF_DAY = datetime.max.time()
+
 
 def _get_datetime(value: Any) -> Optional[datetime]:
     """Turns date/datetime into a datetime and returns None if given anything else"""
     if isinstance(value, datetime):
         return value
     if isinstance(value, date):
-        return datetime.combine(value, datetime.max.time())
+        return datetime.combine(value, _END_OF_DAY)
     return None
 
 
+# Static directories that are always unprotected
+_DEFAULT_UNPROTECTED_PATHS = frozenset(Path(p) for p in ("_downloads", "_static", "_images"))
+
+# Matches what int(delta[:-1]) accepts (apart from underscores) followed by the unit
+_DURATION_RE = re.compile(r"\s*[+-]?\d+\s*[ymwdh]")
+
+
 class SimpleDuration(PydanticModel):
     __root__: str
 
@@ -41,15 +76,10 @@ class SimpleDuration(PydanticModel):
         if not delta:
             raise ValueError("An empty string cannot be turned into a duration")
 
-        try:
-            int(delta[:-1])
-        except:
+        if not _DURATION_RE.fullmatch(delta):
             raise ValueError("Format: <integer>(y|m|d|h|w) e.g. 3d")
 
-        if delta[-1] in ("y", "m", "w", "d", "h"):
-            return values
-        else:
-            raise ValueError("Format: <integer>(y|m|d|h|w) e.g. 3d")
+        return values
 
 AnyDuration = Union[timedelta, SimpleDuration]
 AnyDate = Union[datetime, date, str]
@@ -80,18 +110,19 @@ class ExerciseConfig(PydanticModel):
     default_lang: str
 
     def data_for_language(self, lang: Optional[str] = None) -> dict:
+        data = self.data
         if lang == '_root':
-            return self.data
+            return data
 
         # Try to find version for requested or configured language.
+        # The data may be shared with other requests through the config caches, so it
+        # is copied instead of setting "lang" in place.
         for lang in (lang, self.default_lang):
-            if lang in self.data:
-                data = self.data[lang]
-                data["lang"] = lang
-                return data
+            if lang in data:
+                return {**data[lang], "lang": lang}
 
         # Fallback to any existing language version.
-        return list(self.data.values())[0]
+        return next(iter(data.values()))
 
     @staticmethod
     def load(exercise_key: str, course_dir: str, filename: str, lang: str) -> "ExerciseConfig":
@@ -110,9 +141,28 @@ class ExerciseConfig(PydanticModel):
         @return: exercise config file path, modified time and data dict
         '''
         config_file = ConfigParser.get_config(os.path.join(course_dir, filename))
-        mtime, data = ConfigParser.parse(config_file)
+
+        # Stat before parsing, so that a change made during the parsing causes a reparse next time
+        st = os.stat(config_file)
+        signature: FileSignature = ((config_file, st.st_mtime_ns, st.st_size),)
+
+        cache_key = (os.path.abspath(config_file), exercise_key, lang)
+        with _EXERCISE_CFG_CACHE_LOCK:
+            cached = _EXERCISE_CFG_CACHE.get(cache_key)
+            if cached is not None:
+                _EXERCISE_CFG_CACHE.move_to_end(cache_key)
+        if cached is not None:
+            cached_signature, config = cached
+            if (
+                cached_signature[0] == signature[0]
+                and _file_signature(path for path, _, _ in cached_signature[1:]) == cached_signature[1:]
+            ):
+                return config.copy(update={"ptime": time.time()})
+
+        mtime, data = ConfigParser.parse_with_stat(config_file, st)
         if "include" in data:
-            include_file_timestamp, data = ConfigParser._include(data, config_file, course_dir)
+            include_file_timestamp, data, include_stats = ConfigParser._include(data, config_file, course_dir)
+            signature += tuple((path, include_st.st_mtime_ns, include_st.st_size) for path, include_st in include_stats)
 
             # Save the latest modification time of the exercise in the cache.
             # If there is an included base template, its modification time may be later.
@@ -125,7 +175,7 @@ class ExerciseConfig(PydanticModel):
             version["key"] = exercise_key
             version["mtime"] = mtime
 
-        return ExerciseConfig.parse_obj({
+        config = ExerciseConfig.parse_obj({
             "file": config_file,
             "mtime": mtime,
             "ptime": time.time(),
@@ -133,6 +183,14 @@ class ExerciseConfig(PydanticModel):
             "default_lang": lang,
         })
 
+        with _EXERCISE_CFG_CACHE_LOCK:
+            _EXERCISE_CFG_CACHE[cache_key] = (signature, config)
+            _EXERCISE_CFG_CACHE.move_to_end(cache_key)
+            if len(_EXERCISE_CFG_CACHE) > _EXERCISE_CFG_CACHE_SIZE:
+                _EXERCISE_CFG_CACHE.popitem(last=False)
+
+        return config
+
 
 class Parent(PydanticModel):
     children: List[Union["Chapter", "Exercise", "LTIExercise", "LTI1p3Exercise", "ExerciseCollection"]] = []
@@ -141,21 +199,21 @@ class Parent(PydanticModel):
         for c in self.children:
             c.postprocess(**kwargs)
 
+    def descendants(self) -> Generator["Item", None, None]:
+        """Yields the children recursively in depth-first pre-order"""
+        stack = list(reversed(self.children))
+        while stack:
+            c = stack.pop()
+            yield c
+            stack.extend(reversed(c.children))
+
     def child_categories(self) -> Set[str]:
         """Returns a set of categories of children recursively"""
-        categories: Set[str] = set()
-        for c in self.children:
-            categories.add(c.category)
-            categories.union(c.child_categories())
-        return categories
+        return {c.category for c in self.descendants()}
 
     def child_keys(self) -> List[str]:
         """Returns a list of keys of children recursively"""
-        keys: List[str] = []
-        for c in self.children:
-            keys.append(c.key)
-            keys.extend(c.child_keys())
-        return keys
+        return [c.key for c in self.descendants()]
 
     _ClsT = TypeVar("_ClsT", bound="Parent")
     def gather_types(self, clss: Type[_ClsT]) -> Generator[_ClsT, None, None]:
@@ -187,16 +245,15 @@ class Item(Parent):
         extra = "forbid"
 
     @root_validator(allow_reuse=True, pre=True)
-    def name_or_title(cls, values: Dict[str, Any]):
-        if "name" in values and "title" in values:
-            raise ValueError("Only one of name and title should be specified")
+    def name_or_title_and_remove_fields(cls, values: Dict[str, Any]):
+        # values is a new dict created for the model, so it can be modified in place
         if "title" in values:
+            if "name" in values:
+                raise ValueError("Only one of name and title should be specified")
             values["name"] = values.pop("title")
-        return values
 
-    @root_validator(allow_reuse=True, pre=True)
-    def remove_fields(cls, values: Dict[str, Any]):
-        values = {k:v for k,v in values.items() if k[0] != "_"}
+        for k in [k for k in values if k[:1] == "_"]:
+            del values[k]
         # DEPRECATED: scale_points exists for some reason in some index.yaml
         # it isn't used anywhere though. It should be removed altogether
         values.pop("scale_points", None)
@@ -240,6 +297,17 @@ class Exercise(Item):
         else:
             return None
 
+    def load_config(self, course_dir: str, grader_config_dir: str, default_lang: str) -> None:
+        """Loads the exercise config file (if any) into _config_obj"""
+        LOGGER.debug('Loading exercise "%s/%s"', course_dir, self.key)
+        config_file_info = self.config_file_info(course_dir, grader_config_dir)
+        if config_file_info:
+            self._config_obj = ExerciseConfig.load(
+                self.key,
+                *config_file_info,
+                default_lang,
+            )
+
     def postprocess(self, *, course_key: str, course_dir: str, grader_config_dir: str, default_lang: str, **kwargs: Any):
         super().postprocess(
             course_key = course_key,
@@ -249,14 +317,8 @@ class Exercise(Item):
             **kwargs,
         )
 
-        LOGGER.debug('Loading exercise "%s/%s"', course_dir, self.key)
-        config_file_info = self.config_file_info(course_dir, grader_config_dir)
-        if config_file_info:
-            self._config_obj = ExerciseConfig.load(
-                self.key,
-                *config_file_info,
-                default_lang,
-            )
+        if self._config_obj is None:
+            self.load_config(course_dir, grader_config_dir, default_lang)
 
         # DEPRECATED: default configure settings
         # this is for backwards compatibility and should be removed in the future
@@ -433,9 +495,25 @@ class Course(PydanticModel):
     unprotected_paths: NotRequired[Set[Path]]
     configures: List[ConfigureOptions] = []
 
-    def postprocess(self, course_key: str, **kwargs: Any):
+    def postprocess(self, course_key: str, *, course_dir: str, grader_config_dir: str, default_lang: str, **kwargs: Any):
+        if settings.PARALLEL_COURSE_LOAD:
+            # Loading the exercise configs is mostly file IO, so load them in parallel
+            # before the rest of the postprocessing
+            with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+                # list() makes sure that any exceptions get raised
+                list(executor.map(
+                    lambda exercise: exercise.load_config(course_dir, grader_config_dir, default_lang),
+                    self.exercises(),
+                ))
+
         for c in self.modules:
-            c.postprocess(course_key=course_key, **kwargs)
+            c.postprocess(
+                course_key=course_key,
+                course_dir=course_dir,
+                grader_config_dir=grader_config_dir,
+                default_lang=default_lang,
+                **kwargs,
+            )
 
         if self.head_urls is not Undefined:
             nurls: List[Union[AnyHttpUrl, Path]] = []
@@ -488,38 +566,28 @@ class Course(PydanticModel):
                 raise ValueError("Unprotected paths must be relative to the static directory (i.e. they cannot start with /)")
             if not is_subpath(path):
                 raise ValueError("Unprotected paths must be under the static directory (paths cannot navigate outside it with ../)")
-        return paths.union(Path(p) for p in ("_downloads", "_static", "_images"))
-
-    @root_validator(allow_reuse=True, skip_on_failure=True)
-    def validate_categories(cls, values: Dict[str, Any]) -> Dict[str, Any]:
-        for m in values["modules"]:
-            for c in m.child_categories():
-                if c not in values["categories"]:
-                    raise ValueError(f"Category not found in categories: {c}")
-        return values
-
-    @root_validator(allow_reuse=True, skip_on_failure=True)
-    def validate_keys(cls, values: Dict[str, Any]) -> Dict[str, Any]:
-        for m in values["modules"]:
-            keys = m.child_keys()
-            keyset = set(keys)
-            if len(keys) != len(keyset):
-                duplicates: Set[str] = set()
-                for key in keys:
-                    if key in duplicates:
-                        continue
-                    elif key not in keyset:
-                        duplicates.add(key)
-                    else:
-                        keyset.remove(key)
-                raise ValueError(f"Duplicate learning object (chapter, exercise) keys: {duplicates}")
-        return values
+        return paths | _DEFAULT_UNPROTECTED_PATHS
 
     @root_validator(allow_reuse=True, skip_on_failure=True)
-    def validate_module_dates(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+    def validate_modules(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+        """Validates the categories and keys of the learning objects and the dates of the modules in one pass"""
+        categories = values["categories"]
         end = values.get("end")
         end_dt = _get_datetime(end)
         for i, m in enumerate(values["modules"]):
+            keys: Set[str] = set()
+            duplicates: Set[str] = set()
+            for c in m.descendants():
+                if c.category not in categories:
+                    raise ValueError(f"Category not found in categories: {c.category}")
+                if c.key in keys:
+                    duplicates.add(c.key)
+                else:
+                    keys.add(c.key)
+
+            if duplicates:
+                raise ValueError(f"Duplicate learning object (chapter, exercise) keys: {duplicates}")
+
             close_dt = _get_datetime(m.close)
             if close_dt and end_dt and close_dt > end_dt:
                 m.add_warning(f"Course 'end' ({end}) before module {i} 'close' ({m.close})", "close")
@@ -1,9 +1,15 @@
+from collections import OrderedDict
+from functools import lru_cache
 import io
 import json
 import logging
+import mmap
 import os
+import pickle
 import re
-from typing import Callable, Dict, Optional, Tuple
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from django.template.context import Context
 import yaml
 
@@ -16,6 +22,18 @@ from util.localize import DEFAULT_LANG
 
 LOGGER = logging.getLogger('main')
 
+# Pickled results of parsing config files keyed by (path, st_mtime_ns, st_size, loader).
+# Unpickling is much faster than parsing YAML, and included base templates are usually
+# shared by many exercises.
+_PARSED_FILE_CACHE: "OrderedDict[Tuple[str, int, int, Optional[Callable]], bytes]" = OrderedDict()
+_PARSED_FILE_CACHE_SIZE = 1024
+_PARSED_FILE_CACHE_LOCK = threading.Lock()
+
+# Directory listings are not cached if the directory was changed less than this many nanoseconds ago.
+# A change within the same timestamp tick doesn't change the mtime, so a recent listing could go stale
+# without the cache key changing. This covers the coarse timestamps of some filesystems.
+_DIR_CACHE_MIN_AGE_NS = 2_000_000_000
+
 
 class ConfigError(Exception):
     '''
@@ -31,6 +49,68 @@ class ConfigError(Exception):
         return repr(self.value)
 
 
+def _list_dir(dir_path: str) -> Dict[str, bool]:
+    """Returns a dict that maps the names of the entries in <dir_path> to whether they are files"""
+    with os.scandir(dir_path) as it:
+        return {entry.name: entry.is_file() for entry in it}
+
+
+@lru_cache(maxsize=1024)
+def _cached_list_dir(dir_path: str, dir_ino: int, dir_mtime_ns: int, dir_ctime_ns: int) -> Dict[str, bool]:
+    """
+    Cached _list_dir. The inode, mtime and ctime of the directory are only used as a part of the
+    cache key: replacing the directory or adding or removing entries changes them, which
+    invalidates the cached listing.
+    """
+    return _list_dir(dir_path)
+
+
+def _dir_files(dir_path: str) -> Dict[str, bool]:
+    st = os.stat(dir_path)
+    if time.time_ns() - max(st.st_mtime_ns, st.st_ctime_ns) < _DIR_CACHE_MIN_AGE_NS:
+        return _list_dir(dir_path)
+    return _cached_list_dir(dir_path, st.st_ino, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def _load_cached(path: str, st: os.stat_result, loader: Optional[Callable], load: Callable[[], Any]) -> Any:
+    """
+    Returns a fresh copy of the data returned by <load> for the file at <path>.
+    <st> must be the result of os.stat(path) taken before the file is read.
+    """
+    key = (path, st.st_mtime_ns, st.st_size, loader)
+    with _PARSED_FILE_CACHE_LOCK:
+        snapshot = _PARSED_FILE_CACHE.get(key)
+        if snapshot is not None:
+            _PARSED_FILE_CACHE.move_to_end(key)
+    if snapshot is not None:
+        return pickle.loads(snapshot)
+
+    data = load()
+    try:
+        snapshot = pickle.dumps(data, protocol=5)
+    except Exception:
+        return data
+
+    with _PARSED_FILE_CACHE_LOCK:
+        _PARSED_FILE_CACHE[key] = snapshot
+        if len(_PARSED_FILE_CACHE) > _PARSED_FILE_CACHE_SIZE:
+            _PARSED_FILE_CACHE.popitem(last=False)
+    return data
+
+
+def _load_mapped(path: str, loader: Callable) -> Any:
+    """
+    Loads <path> with <loader> from a read-only memory map of the file. The loaders
+    read the whole file at once, so this avoids the buffered copies of a file object.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            return loader(f)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return loader(buffer)
+
+
 class ConfigParser:
     '''
     Provides configuration data parsed and automatically updated on change.
@@ -74,22 +154,26 @@ class ConfigParser:
         @return: the full path to the corresponding config file
         @raises ConfigError: if multiple rivalling configs or none exist
         '''
+        dir_path, name = os.path.split(path)
+        try:
+            dir_path = os.path.abspath(dir_path)
+            files = _dir_files(dir_path)
+        except OSError:
+            raise ConfigError('No supported config at "%s"' % (path))
 
         # Check for complete path.
-        if os.path.isfile(path):
-            ext = os.path.splitext(path)[1]
+        if files.get(name):
+            ext = os.path.splitext(name)[1]
             if len(ext) > 0 and ext[1:] in ConfigParser.FORMATS:
                 return path
 
         # Try supported format extensions.
         config_file = None
-        if os.path.isdir(os.path.dirname(path)):
-            for ext in ConfigParser.FORMATS.keys():
-                f = "%s.%s" % (path, ext)
-                if os.path.isfile(f):
-                    if config_file != None:
-                        raise ConfigError('Multiple config files for "%s"' % (path))
-                    config_file = f
+        for ext in ConfigParser.FORMATS.keys():
+            if files.get("%s.%s" % (name, ext)):
+                if config_file != None:
+                    raise ConfigError('Multiple config files for "%s"' % (path))
+                config_file = "%s.%s" % (path, ext)
         if not config_file:
             raise ConfigError('No supported config at "%s"' % (path))
         return config_file
@@ -107,6 +191,23 @@ class ConfigParser:
         @rtype: C{dict}
         @return: mtime of the file and an object representing the configuration file or None
         '''
+        data = ConfigParser._read(path, loader)
+        return os.path.getmtime(path), data
+
+
+    @staticmethod
+    def parse_with_stat(path: str, st: os.stat_result, loader: Optional[Callable] = None) -> Tuple[float, dict]:
+        '''
+        Same as parse but takes the mtime from <st> instead of stat'ing the file again.
+
+        @type st: C{os.stat_result}
+        @param st: the result of os.stat(path), taken before the file is read
+        '''
+        return st.st_mtime, _load_cached(path, st, loader, lambda: ConfigParser._read(path, loader))
+
+
+    @staticmethod
+    def _read(path: str, loader: Optional[Callable] = None) -> dict:
         if not loader:
             try:
                 loader = ConfigParser.FORMATS[os.path.splitext(path)[1][1:]]
@@ -118,11 +219,11 @@ class ConfigParser:
                 data = loader(f)
             except (ValueError, yaml.YAMLError) as e:
                 raise ConfigError("Configuration error in %s" % (path), e)
-        return os.path.getmtime(path), data
+        return data
 
 
     @staticmethod
-    def _include(data: dict, target_file: str, course_dir: str) -> Tuple[float, dict]:
+    def _include(data: dict, target_file: str, course_dir: str) -> Tuple[float, dict, List[Tuple[str, os.stat_result]]]:
         '''
         Includes the config files defined in data["include"] into data.
 
@@ -132,8 +233,8 @@ class ConfigParser:
         @param target_file: path to the include target, for error messages only
         @type course_dir: C{str}
         @param course_dir: a path to the course root directory
-        @rtype: C{dict}
-        @return: updated data
+        @rtype: C{tuple}
+        @return: latest mtime of the included files, updated data and (path, stat result) of the included files
         '''
         return_data = data.copy()
         include_data_list = data.get("include")
@@ -143,6 +244,7 @@ class ConfigParser:
             )
 
         mtime = 0.0
+        include_stats = []
         for include_data in include_data_list:
             try:
                 ConfigParser.check_fields(target_file, include_data, ("file",))
@@ -150,7 +252,9 @@ class ConfigParser:
                 include_file = ConfigParser.get_config(os.path.join(course_dir, include_data["file"]))
                 loader = ConfigParser.FORMATS[os.path.splitext(include_file)[1][1:]]
 
-                mtime = max(mtime, os.path.getmtime(include_file))
+                st = os.stat(include_file)
+                include_stats.append((include_file, st))
+                mtime = max(mtime, st.st_mtime)
 
                 if "template_context" in include_data:
                     # Load new data from rendered include file string
@@ -164,8 +268,7 @@ class ConfigParser:
                     new_data = loader(io.StringIO(rendered))
                 else:
                     # Load new data directly from the include file
-                    with open(include_file, 'r') as f:
-                        new_data = loader(f)
+                    new_data = _load_cached(include_file, st, loader, lambda: _load_mapped(include_file, loader))
             except (OSError, KeyError, ValueError, yaml.YAMLError, TemplateDoesNotExist, TemplateSyntaxError) as e:
                 raise ConfigError(
                     f'Error in parsing the config file to be included into "{target_file}".', error=e,
@@ -192,7 +295,7 @@ class ConfigParser:
                                 new_value,
                                 include_file))
 
-        return mtime, return_data
+        return mtime, return_data, include_stats
 
 
     @staticmethod
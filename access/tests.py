@@ -11,6 +11,7 @@ from django.conf import settings
 from django.test import TestCase, override_settings
 
 from access.config import CourseConfig
+from access.course import ExerciseConfig
 from access.parser import ConfigParser
 from builder.models import Course as CourseModel
 from util.files import rm_path
@@ -91,3 +92,22 @@ class ConfigTestCase(TestCase):
         self.assertGreater(root.ptime, root.mtime)
         self.assertGreater(root.mtime, mtime)
         self.assertGreater(root.ptime, ptime)
+
+    def test_exercise_cache_reload(self):
+        course_key = self.get_course_key()
+
+        root = CourseConfig.get(course_key)
+        exercise = next(e for e in root.exercises.values() if e._config_obj is not None)
+        course_dir, filename = exercise.config_file_info(root.dir, root.grader_config_dir)
+
+        config = ExerciseConfig.load(exercise.key, course_dir, filename, root.lang)
+        cached = ExerciseConfig.load(exercise.key, course_dir, filename, root.lang)
+        # Unchanged files are not parsed again
+        self.assertIs(cached.data, config.data)
+        self.assertGreaterEqual(cached.ptime, config.ptime)
+
+        time.sleep(0.01)
+        os.utime(config.file)
+        reloaded = ExerciseConfig.load(exercise.key, course_dir, filename, root.lang)
+        self.assertIsNot(reloaded.data, config.data)
+        self.assertGreater(reloaded.mtime, config.mtime)
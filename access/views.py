@@ -266,7 +266,7 @@ def aplus_json(request: HttpRequest, course_key: str) -> HttpResponse:
         try:
             with FileLock(path, write=True, timeout=settings.APLUS_JSON_FILELOCK_TIMEOUT):
                 with open(defaults_path, "w") as f:
-                    json.dump(exercise_defaults, f)
+                    f.write(json.dumps(exercise_defaults))
         except BlockingIOError:
             errors.append(
                 "Failed to write exercise defaults as something has a lock on the config directory. Try again later."
@@ -15,13 +15,14 @@ class AppConfig(DjangoAppConfig):
     def ready(self) -> None:
         global ssh_key
 
-        if not Path(settings.SSH_KEY_PATH).exists():
-            LOGGER.info(f"Generating SSH key in {settings.SSH_KEY_PATH}")
-            Path(settings.SSH_KEY_PATH).parent.mkdir(parents=True, exist_ok=True)
-            process = subprocess.run(["ssh-keygen", "-t", "ecdsa", "-b 521", "-q", "-N", "", "-f", settings.SSH_KEY_PATH], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf8')
+        key_path = Path(settings.SSH_KEY_PATH)
+        if not key_path.exists():
+            LOGGER.info(f"Generating SSH key in {key_path}")
+            key_path.parent.mkdir(parents=True, exist_ok=True)
+            process = subprocess.run(["ssh-keygen", "-t", "ecdsa", "-b", "521", "-q", "-N", "", "-f", str(key_path)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf8')
             if process.returncode != 0:
                 raise Exception("Failed to generate ssh key:\n" + process.stdout)
 
-        ssh_key = open(settings.SSH_KEY_PATH + ".pub").read()
+        ssh_key = Path(settings.SSH_KEY_PATH + ".pub").read_text()
 
         return super().ready()
\ No newline at end of file
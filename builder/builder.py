@@ -1,5 +1,5 @@
+from collections import deque
 import importlib
-from io import StringIO
 import json
 from json.decoder import JSONDecodeError
 import logging
@@ -7,12 +7,11 @@ from pathlib import Path
 import os
 import random
 import shlex
-import shutil
 import string
 import sys
 import traceback
 from types import ModuleType
-from typing import List, Optional, Set, Tuple
+from typing import Deque, Dict, List, Optional, Set, Tuple
 import urllib.parse
 
 from django.conf import settings
@@ -22,21 +21,22 @@ from huey.exceptions import RetryTask, TaskLockedException
 from pydantic.error_wrappers import ValidationError
 
 from aplus_auth.payload import Permission, Permissions
-from aplus_auth.requests import post
+from aplus_auth.requests import Session
 
 from access.config import ConfigSource, CourseConfig, load_meta, META
 from access.parser import ConfigError
 from builder.configure import configure_graders, publish_graders
 from util.files import (
-    copyfile,
+    copy_files,
     copys_async,
     is_subpath,
     renames,
-    rm_except,
+    rm_path,
+    rm_paths_async,
     FileLock,
-    rsync
+    rsync,
 )
-from util.git import checkout, clean, clone_if_doesnt_exist, get_diff_names, get_commit_hash_or_none, get_commit_metadata
+from util.git import checkout, clean, clone_if_doesnt_exist, get_diff_names_between, get_commit_hash_or_none, get_commit_metadata, GitBatch
 from util.perfmonitor import PerfMonitor
 from util.pydantic import validation_error_str, validation_warning_str
 from util.static import static_url, static_url_path, symbolic_link
@@ -49,9 +49,27 @@ logger = logging.getLogger("builder.builder")
 build_logger = logging.getLogger("builder.build")
 build_logger.setLevel(logging.DEBUG)
 
+# Shared between the requests to A+ so that the connections are kept alive and reused.
+# The authentication token is still created separately for each request from its permissions.
+aplus_session = Session()
+
+# How many of the latest course updates are checked when detecting the files changed since the last successful update
+MAX_CHANGED_FILES_UPDATES = 50
+
+# If more files than this have changed, they are written to CHANGED_FILES_FILE (relative to
+# the course directory) instead of the CHANGED_FILES environment variable of the build
+MAX_CHANGED_FILES_IN_ENV = 1000
+CHANGED_FILES_FILE = ".changed_files"
+
 
 def _import_path(path: str) -> ModuleType:
-    """Imports an attribute (e.g. class or function) from a module from a specified path"""
+    """
+    Imports a module from a specified path, or by its dotted name if the path isn't a .py file.
+    Both ways use the bytecode cache (__pycache__) like regular imports do.
+    """
+    if not path.endswith(".py"):
+        return importlib.import_module(path)
+
     spec = importlib.util.spec_from_file_location("builder_module", path)
     if spec is None:
         raise ImportError(f"Couldn't find {path}")
@@ -90,36 +108,35 @@ def update_from_git(build_path: str, course: Course) -> Tuple[bool, Optional[Set
         # Get changed files since last successful update.
         # A failed update may mess up an output file, so we also need to include any changes that
         # were part of failed updates but may have been reverted later. This is why we need to
-        # call get_diff_names for each consecutive update pair instead of just comparing to the last
-        # successful one.
+        # diff each consecutive update pair instead of just comparing to the last successful one.
+        # The pairs are diffed in a single git process by get_diff_names_between.
 
+        # Only the commit hash and status are needed. The walk is limited to
+        # MAX_CHANGED_FILES_UPDATES updates: if none of them were successful, the changed
+        # files are considered unknown, which is handled the same as no successful updates.
         updates = CourseUpdate.objects.filter(
                 course=course,
                 status__in=(CourseUpdate.Status.SUCCESS, CourseUpdate.Status.FAILED)
-            ).order_by("-request_time")
-
-        changed_files = set()
-        last_commit_hash = None
-        for update in updates:
-            # If any update in the chain doesn't have a commit hash, we can't reliably detect the changed files
-            if update.commit_hash is None:
-                changed_files = None
-                break
+            ).order_by("-request_time").values_list("commit_hash", "status")[:MAX_CHANGED_FILES_UPDATES]
 
-            diff_error, changed = get_diff_names(build_path, update.commit_hash, last_commit_hash)
-            if diff_error:
-                build_logger.error(diff_error)
-                changed_files = None
+        # Stays None if none of the previous updates were successful (cannot detect changes since
+        # last successful update) or if any update in the chain doesn't have a commit hash (cannot
+        # reliably detect the changed files)
+        changed_files = None
+        commit_hashes = []
+        for commit_hash, status in updates:
+            if commit_hash is None:
                 break
-            changed_files.update(changed)
 
-            last_commit_hash = update.commit_hash
+            commit_hashes.append(commit_hash)
 
-            if update.status == CourseUpdate.Status.SUCCESS:
+            if status == CourseUpdate.Status.SUCCESS:
+                diff_error, changed = get_diff_names_between(build_path, commit_hashes)
+                if diff_error:
+                    build_logger.error(diff_error)
+                else:
+                    changed_files = set(changed)
                 break
-        else:
-            # None of the previous updates were successful: cannot detect changes since last successful update
-            changed_files = None
     elif not clone_status:
         build_logger.info("------------\nFailed to clone repository\n------------\n\n")
         return False, None
@@ -133,8 +150,43 @@ def update_from_git(build_path: str, course: Course) -> Tuple[bool, Optional[Set
     return True, changed_files
 
 
-def log_progress_update(update: CourseUpdate, log_stream: StringIO) -> None:
-    update.log = log_stream.getvalue() + "\n\n..."
+class LogBuffer:
+    """
+    A text stream for the build log that keeps at most <max_writes> writes: the first half
+    and the latest half. The beginning has the git output and usually the first errors, and
+    the end shows where the build stopped. The writes in between are dropped.
+    logging.StreamHandler writes each log record with a single write call.
+    """
+    def __init__(self, max_writes: int):
+        self.max_head = (max_writes + 1) // 2
+        self.head: List[str] = []
+        self.tail: Deque[str] = deque(maxlen=max_writes - self.max_head)
+        self.dropped = 0
+
+    def write(self, s: str) -> int:
+        if len(self.head) < self.max_head:
+            self.head.append(s)
+        else:
+            if len(self.tail) == self.tail.maxlen:
+                self.dropped += 1
+            self.tail.append(s)
+        return len(s)
+
+    def flush(self) -> None:
+        pass
+
+    def getvalue(self) -> str:
+        if self.dropped:
+            return "".join(self.head) + f"\n[... {self.dropped} log records omitted ...]\n\n" + "".join(self.tail)
+        return "".join(self.head) + "".join(self.tail)
+
+
+def log_progress_update(update: CourseUpdate, log_stream: LogBuffer) -> None:
+    log = log_stream.getvalue() + "\n\n..."
+    # Nothing was logged since the last progress update
+    if log == update.log:
+        return
+    update.log = log
     update.save(update_fields=["log"])
 
 
@@ -144,8 +196,10 @@ def build(
         image: Optional[str] = None,
         command: Optional[str] = None,
         changed_files: Set[str] = ["*"],
+        meta: Optional[Dict[str, str]] = None,
         ) -> bool:
-    meta = load_meta(path)
+    if meta is None:
+        meta = load_meta(path)
 
     if image is not None:
         build_image = image
@@ -185,9 +239,18 @@ def build(
         "COURSE_ID": str(course.remote_id),
         "STATIC_URL_PATH": static_url_path(course.key),
         "STATIC_CONTENT_HOST": static_url(course.key),
-        "CHANGED_FILES": "\n".join(changed_files),
     }
 
+    if len(changed_files) > MAX_CHANGED_FILES_IN_ENV:
+        # Environment variables have a size limit, so long lists are passed in a file in the course
+        # directory instead. Build images that don't read the file still do a full build.
+        with open(path / CHANGED_FILES_FILE, "w") as f:
+            f.write("\n".join(changed_files))
+        env["CHANGED_FILES"] = "*"
+        env["CHANGED_FILES_FILE"] = CHANGED_FILES_FILE
+    else:
+        env["CHANGED_FILES"] = "\n".join(changed_files)
+
     if build_command is not None:
         build_command = shlex.split(build_command)
 
@@ -216,7 +279,7 @@ def send_error_mail(course: Course, subject: str, message: str) -> bool:
         "message": message,
     }
     try:
-        response = post(email_url, permissions=permissions, data=data, headers={"Accept": "application/json, application/*"})
+        response = aplus_session.post(email_url, permissions=permissions, data=data, headers={"Accept": "application/json, application/*"})
     except:
         logger.exception(f"Failed to send email for {course.key}")
         build_logger.exception(f"Failed to send error email")
@@ -238,7 +301,7 @@ def notify_update(course: Course):
         notification_url = urllib.parse.urljoin(settings.FRONTEND_URL, f"api/v2/courses/{course.remote_id}/notify_update/")
         permissions = Permissions()
         permissions.instances.add(Permission.WRITE, id=course.remote_id)
-        response = post(notification_url, permissions=permissions, data={"email_on_error": course.email_on_error}, headers={"Accept": "application/json, application/*"})
+        response = aplus_session.post(notification_url, permissions=permissions, data={"email_on_error": course.email_on_error}, headers={"Accept": "application/json, application/*"})
     except Exception as e:
         logger.exception(f"Failed to notify_update for course id {course.remote_id}")
         errors.append(str(e))
@@ -248,7 +311,7 @@ def notify_update(course: Course):
             errors.append(response.reason)
         else:
             try:
-                data = json.loads(response.text)
+                data = json.loads(response.content)
             except JSONDecodeError:
                 logger.exception("Failed to load notify_update response JSON")
                 errors.append("Failed to load notify_update response JSON")
@@ -280,13 +343,21 @@ def notify_update(course: Course):
 
 def is_self_contained(path: PathLike) -> Tuple[bool, Optional[str]]:
     spath = os.fspath(path)
-    for root, _, files in os.walk(spath):
-        rpath = Path(root)
-        for file in files:
-            if not is_subpath(str((rpath / file).resolve()), spath):
-                return False, f"{rpath / file} links to a path outside the course directory"
-            if os.path.islink(rpath / file) and os.path.isabs(os.readlink(rpath / file)):
-                return False, f"{rpath / file} is an absolute symlink: this will break the course"
+    # Only symlinks can point outside the course directory: regular files are inside it as
+    # symlinked directories are not descended into (same as os.walk). The build output isn't
+    # tracked by git, so the directory needs to be walked instead of using git ls-tree.
+    dirs = [spath]
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                elif entry.is_symlink():
+                    if not is_subpath(os.path.realpath(entry.path), spath):
+                        return False, f"{entry.path} links to a path outside the course directory"
+                    if os.path.isabs(os.readlink(entry.path)):
+                        return False, f"{entry.path} is an absolute symlink: this will break the course"
 
     return True, None
 
@@ -314,95 +385,111 @@ def store(perfmonitor: PerfMonitor, config: CourseConfig) -> bool:
 
     store_path, store_defaults_path, store_version_path = CourseConfig.file_paths(course_key, source=ConfigSource.STORE)
 
-    build_logger.info("Acquiring file lock...")
-    # Lock the course folder in store so that no other process modifies it at the same time.
-    # If any other process already has a lock to the course folder, this will block until
-    # the lock is released or BUILD_FILELOCK_TIMEOUT seconds has passed (in which case
-    # the build fails). The likely situation for this blocking is that the copys_async function
-    # called from the publish function has the lock.
-    with FileLock(store_path, write=True, timeout=settings.BUILD_FILELOCK_TIMEOUT):
-        build_logger.info("File lock acquired.")
+    build_path = CourseConfig.path_to(course_key, source=ConfigSource.BUILD)
 
-        build_logger.info("Copying the built materials")
+    static_dir = config.data.static_dir or ""
+    store_static_path = CourseConfig.path_to(course_key, static_dir, source=ConfigSource.STORE)
 
-        static_dir = config.data.static_dir or ""
+    grader_config_dir = str(Path(config.grader_config_dir).relative_to(config.dir))
 
-        # Remove all stored files (for the course) exept the static directory which we will rsync over.
-        rm_except(store_path, CourseConfig.path_to(course_key, static_dir, source=ConfigSource.STORE))
+    required_files = set()
 
-        perfmonitor.checkpoint("Remove old stored files")
+    # Add the metafile to the files to be copied if it exists
+    if os.path.exists(os.path.join(build_path, META)):
+        required_files.add(META)
 
-        dst = CourseConfig.path_to(course_key, static_dir, source=ConfigSource.STORE)
-        Path(dst).parent.mkdir(parents=True, exist_ok=True)
-        # rsync the static directory
-        num_changed = rsync(
-            CourseConfig.path_to(course_key, static_dir, source=ConfigSource.BUILD),
-            dst,
+    # Find other (not static directory) required files
+    for exercise in config.data.exercises():
+        config_file_info = exercise.config_file_info(
+            "",
+            grader_config_dir
         )
+        if config_file_info:
+            required_files.add(os.path.join(*config_file_info))
+
+        if exercise._config_obj:
+            for lang_data in exercise._config_obj.data.values():
+                if "template_files" in lang_data:
+                    required_files.update(lang_data["template_files"])
+                if "model_files" in lang_data:
+                    required_files.update(lang_data["model_files"])
+
+                for include_data in lang_data.get("include", []):
+                    required_files.add(include_data["file"])
+
+    required_files = {
+        file[1:] if file.startswith("/") else file
+        for file in required_files
+    }
 
-        build_logger.info(f"Rsync: {num_changed} files in {static_dir} changed")
-
-        perfmonitor.checkpoint("Copy static files")
-
-        grader_config_dir = str(Path(config.grader_config_dir).relative_to(config.dir))
-
-        copy_files = set()
-
-        # Add the metafile to the files to be copied if it exists
-        if os.path.exists(CourseConfig.path_to(course_key, META, source=ConfigSource.BUILD)):
-            copy_files.add(META)
-
-        # Find other (not static directory) required files
-        for exercise in config.data.exercises():
-            config_file_info = exercise.config_file_info(
-                "",
-                grader_config_dir
-            )
-            if config_file_info:
-                copy_files.add(os.path.join(*config_file_info))
-
-            if exercise._config_obj:
-                for lang_data in exercise._config_obj.data.values():
-                    if "template_files" in lang_data:
-                        copy_files.update(lang_data["template_files"])
-                    if "model_files" in lang_data:
-                        copy_files.update(lang_data["model_files"])
+    existing_files = [str(Path(config.file).relative_to(config.dir))]
+    for file in required_files:
+        if not os.path.exists(os.path.join(build_path, file)):
+            build_logger.warning(f"Couldn't find file '{file}'")
+            continue
 
-                    for include_data in lang_data.get("include", []):
-                        copy_files.add(include_data["file"])
+        existing_files.append(file)
 
-        copy_files = {
-            file[1:] if file.startswith("/") else file
-            for file in copy_files
-        }
+    build_logger.info("Copying the built materials")
 
-        index_file = str(Path(config.file).relative_to(config.dir))
-        dst = CourseConfig.path_to(course_key, index_file, source=ConfigSource.STORE)
-        Path(dst).parent.mkdir(parents=True, exist_ok=True)
-        copyfile(config.file, dst)
+    # rsync the static directory to a staging directory without holding the lock. Files that
+    # haven't changed since the stored version are hard linked from it instead of copied.
+    # The staging directory is in STORE_PATH so that it can be renamed into place. rsync
+    # creates it, so it gets the same permissions as the directories it used to create.
+    staging_path = CourseConfig.path_to(f".{course_key}.static-{_get_version_id()}", source=ConfigSource.STORE)
+    old_store_path = None
+    try:
+        num_changed = rsync(
+            os.path.join(build_path, static_dir),
+            staging_path,
+            link_dest=store_static_path,
+        )
 
-        # Copy the other files
-        for file in copy_files:
-            src = CourseConfig.path_to(course_key, file, source=ConfigSource.BUILD)
-            if not os.path.exists(src):
-                build_logger.warning(f"Couldn't find file '{file}'")
-                continue
+        build_logger.info(f"Rsync: {num_changed} files in {static_dir} changed")
 
-            dst = CourseConfig.path_to(course_key, file, source=ConfigSource.STORE)
-            Path(dst).parent.mkdir(parents=True, exist_ok=True)
+        perfmonitor.checkpoint("Copy static files")
 
-            copyfile(src, dst)
+        build_logger.info("Acquiring file lock...")
+        # Lock the course folder in store so that no other process modifies it at the same time.
+        # If any other process already has a lock to the course folder, this will block until
+        # the lock is released or BUILD_FILELOCK_TIMEOUT seconds has passed (in which case
+        # the build fails). The likely situation for this blocking is that the copys_async function
+        # called from the publish function has the lock.
+        with FileLock(store_path, write=True, timeout=settings.BUILD_FILELOCK_TIMEOUT):
+            build_logger.info("File lock acquired.")
+
+            # Replace all stored files (for the course) with the staged static directory.
+            # The old files are moved aside and removed after the lock has been released.
+            if os.path.lexists(store_path):
+                old_store_path = CourseConfig.path_to(f".{course_key}.old-{_get_version_id()}", source=ConfigSource.STORE)
+                os.rename(store_path, old_store_path)
+            Path(store_static_path).parent.mkdir(parents=True, exist_ok=True)
+            os.rename(staging_path, store_static_path)
+
+            perfmonitor.checkpoint("Replace old stored files")
+
+            # Copy the index file and the other files
+            copy_files(
+                build_path,
+                store_path,
+                existing_files,
+            )
 
-        # Copy exercise defaults
-        with open(store_defaults_path, "w") as f:
-            json.dump(exercise_defaults, f)
+            # Copy exercise defaults
+            with open(store_defaults_path, "w") as f:
+                f.write(json.dumps(exercise_defaults))
 
-        # Copy version file
-        if config.version_id is not None:
-            with open(store_version_path, "w") as f:
-                f.write(config.version_id)
+            # Copy version file
+            if config.version_id is not None:
+                with open(store_version_path, "w") as f:
+                    f.write(config.version_id)
 
-        perfmonitor.checkpoint("Copy other files")
+            perfmonitor.checkpoint("Copy other files")
+    finally:
+        # Only exists if something failed before it was renamed into place
+        rm_path(staging_path)
+        if old_store_path is not None:
+            rm_paths_async([old_store_path])
 
     # Save the config to the store cache
     config.save_to_cache(ConfigSource.STORE)
@@ -442,8 +529,9 @@ def publish(course_key: str, source: ConfigSource, version_id: Optional[str]) ->
 
                     config.save_to_cache(ConfigSource.PUBLISH)
                     # Copy files back to store so that rsync has files to compare against.
-                    # This is done asyncronously: the copying might still be ongoing even
-                    # after the publishing is done.
+                    # The files are hard linked: neither the store nor the published files
+                    # are modified in place. This is done asyncronously: the copying might
+                    # still be ongoing even after the publishing is done.
                     copys_async([
                             (prod_path, store_path),
                             (prod_defaults_path, store_defaults_path),
@@ -451,6 +539,7 @@ def publish(course_key: str, source: ConfigSource, version_id: Optional[str]) ->
                         ],
                         read_lock_path=prod_path,
                         write_lock_path=store_path,
+                        link_files=True,
                     )
     elif source == ConfigSource.PUBLISH:
         with FileLock(prod_path, timeout=settings.APLUS_JSON_FILELOCK_TIMEOUT):
@@ -506,6 +595,11 @@ def push_event(
         ) -> None:
     logger.debug(f"push_event: {course_key}")
 
+    # Nothing to build: skip taking the lock. The pending update is created before
+    # push_event is called, so an update cannot be missed because of this.
+    if not CourseUpdate.objects.filter(course__key=course_key, status=CourseUpdate.Status.PENDING).exists():
+        return
+
     try:
         # lock_task to make sure that two updates don't happen at the
         # same time.
@@ -534,9 +628,8 @@ def build_course(
     course: Course = Course.objects.get(key=course_key)
 
     # delete all but latest 10 updates
-    updates = CourseUpdate.objects.filter(course=course).order_by("-request_time")[10:]
-    for update in updates:
-        update.delete()
+    keep_ids = list(CourseUpdate.objects.filter(course=course).order_by("-request_time").values_list("id", flat=True)[:10])
+    CourseUpdate.objects.filter(course=course).exclude(id__in=keep_ids).delete()
     # get pending updates
     updates = CourseUpdate.objects.filter(course=course, status=CourseUpdate.Status.PENDING).order_by("request_time").all()
 
@@ -545,20 +638,20 @@ def build_course(
         return
 
     # skip all but the most recent update
-    for update in updates[:-1]:
-        update.status = CourseUpdate.Status.SKIPPED
-        update.save()
+    if len(updates) > 1:
+        CourseUpdate.objects.filter(id__in=[u.id for u in updates[:-1]]).update(status=CourseUpdate.Status.SKIPPED)
 
     update = updates[-1]
 
     perfmonitor = PerfMonitor()
 
-    log_stream = StringIO()
+    meta = None
+    log_stream = LogBuffer(settings.BUILD_LOG_MAX_RECORDS)
     log_handler = logging.StreamHandler(log_stream)
     build_logger.addHandler(log_handler)
     try:
         update.status = CourseUpdate.Status.RUNNING
-        update.save()
+        update.save(update_fields=["status"])
 
         if course.skip_build_failsafes:
             build_config_source = ConfigSource.PUBLISH
@@ -567,24 +660,30 @@ def build_course(
 
         build_path = CourseConfig.path_to(course_key, source=build_config_source)
 
-        changed_files = None
-        if skip_git:
-            build_logger.info("Skipping git update.")
-        elif course.git_origin:
-            success, changed_files = update_from_git(build_path, course)
-            if not success:
-                return
-        elif settings.LOCAL_COURSE_SOURCE_PATH:
-            path = CourseConfig.local_source_path_to(course_key)
-            build_logger.debug(f"Course origin not set: copying the course sources from {path} to the build directory.")
+        # The HEAD commit is resolved multiple times below: do it using a single git process
+        with GitBatch(build_path):
+            changed_files = None
+            if skip_git:
+                build_logger.info("Skipping git update.")
+            elif course.git_origin:
+                success, changed_files = update_from_git(build_path, course)
+                if not success:
+                    return
+            elif settings.LOCAL_COURSE_SOURCE_PATH:
+                path = CourseConfig.local_source_path_to(course_key)
+                build_logger.debug(f"Course origin not set: copying the course sources from {path} to the build directory.")
+
+                # rsync only writes the files that differ and removes the rest, so the result is the same as
+                # removing the build directory and copying the whole tree. The permissions (e.g. the executable
+                # bits of build scripts) and modification times are kept like shutil.copytree would
+                rsync(path, build_path, preserve_attributes=True)
+            else:
+                build_logger.warning(f"Course origin not set: skipping git update\n")
 
-            shutil.rmtree(build_path, ignore_errors=True)
-            shutil.copytree(path, build_path, symlinks=True)
-        else:
-            build_logger.warning(f"Course origin not set: skipping git update\n")
+            meta = load_meta(build_path)
 
-        update.commit_hash = get_commit_hash_or_none(build_path)
-        update.save(update_fields=["commit_hash"])
+            update.commit_hash = get_commit_hash_or_none(build_path)
+            update.save(update_fields=["commit_hash"])
 
         log_progress_update(update, log_stream)
 
@@ -603,7 +702,7 @@ def build_course(
                 build_logger.info(f"Detected changed files: {', '.join(changed_files)}\n\n")
 
             # build in build_path folder
-            build_status = build(course, Path(build_path), image = build_image, command = build_command, changed_files = changed_files)
+            build_status = build(course, Path(build_path), image = build_image, command = build_command, changed_files = changed_files, meta = meta)
             if not build_status:
                 return
         else:
@@ -684,10 +783,12 @@ def build_course(
         update.log = log_stream.getvalue()
 
         update.updated_time = Now()
-        update.save()
+        update.save(update_fields=["status", "log", "updated_time"])
 
         try:
-            meta = load_meta(build_path)
+            # The meta file isn't loaded if the build failed before the git update was done
+            if meta is None:
+                meta = load_meta(build_path)
             exclude_patterns = shlex.split(meta.get("exclude_patterns", ""))
 
             clean_status = clean(build_path, course.git_origin, course.git_branch, exclude_patterns, logger=build_logger)
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 import json
 from json.decoder import JSONDecodeError
@@ -110,6 +111,18 @@ def configure_url(
     return response, None
 
 
+def _configure_urls(
+        calls: List[Tuple[Tuple[Any, ...], Dict[str, Any]]],
+        ) -> List[Tuple[Optional[Response], Optional[Union[str, Dict[str,str]]]]]:
+    """Calls configure_url with each (args, kwargs) pair in parallel. Returns the results in the same order."""
+    if len(calls) <= 1:
+        return [configure_url(*args, **kwargs) for args, kwargs in calls]
+
+    with ThreadPoolExecutor(max_workers=min(settings.CONFIGURE_MAX_WORKERS, len(calls))) as executor:
+        futures = [executor.submit(configure_url, *args, **kwargs) for args, kwargs in calls]
+        return [future.result() for future in futures]
+
+
 def configure_graders(config: CourseConfig) -> Tuple[Dict[str, Any], List[Union[str, Dict[str,str]]]]:
     """Configures services based on the given course config"""
     course_key = config.key
@@ -137,9 +150,8 @@ def configure_graders(config: CourseConfig) -> Tuple[Dict[str, Any], List[Union[
 
     course_spec = config.data.dict(exclude={"static_dir", "configures", "unprotected_paths"}, by_alias=True)
 
-    exercise_defaults: Dict[str, Any] = {}
-    errors: List[Union[str, Dict[str,str]]] = []
-    # Send configurations for each service
+    # Collect the configurations for each service
+    calls: List[Tuple[Tuple[Any, ...], Dict[str, Any]]] = []
     for url, (course_files, exercises) in configures.items():
         exercise_data: List[Dict[str, Any]] = []
         for exercise in exercises:
@@ -166,18 +178,27 @@ def configure_graders(config: CourseConfig) -> Tuple[Dict[str, Any], List[Union[
             ] if personalized_exercises_path_exists else [],
         ))
 
-        response, error = configure_url(url, course_id, course_key, config.dir, files, course_spec=course_spec, exercises=exercise_data, version_id=config.version_id)
+        calls.append((
+            (url, course_id, course_key, config.dir, files),
+            {"course_spec": course_spec, "exercises": exercise_data, "version_id": config.version_id},
+        ))
+
+    exercise_defaults: Dict[str, Any] = {}
+    errors: List[Union[str, Dict[str,str]]] = []
+    # Send the configurations to the services in parallel
+    results = _configure_urls(calls)
+    for (url, (_, exercises)), (response, error) in zip(configures.items(), results):
         if error is not None:
             errors.append(error)
 
         if response is not None and response.status_code == 200:
-            if not response.text and exercises:
+            if not response.content and exercises:
                 logger.warn(f"{url} returned an empty response on exercise configuration")
                 errors.append(f"{url} returned an empty response on exercise configuration")
             else:
                 try:
                     logger.debug(f"Loading from {url}")
-                    defaults = json.loads(response.text)
+                    defaults = json.loads(response.content)
                 except JSONDecodeError as e:
                     logger.info(f"Couldn't load configure response:\n{e}")
                     logger.debug(f"{url} returned {response.text}")
@@ -206,17 +227,22 @@ def publish_graders(config: CourseConfig) -> List[str]:
     if course_id is None and configure_urls:
         raise ValueError("Remote id not set: cannot publish")
 
+    urls = list(configure_urls)
+    results = _configure_urls([
+        ((url, course_id, config.key, config.dir, None), {"publish": True, "version_id": config.version_id})
+        for url in urls
+    ])
+
     errors = []
-    for url in configure_urls:
-        response, error = configure_url(url, course_id, config.key, config.dir, None, publish=True, version_id=config.version_id)
+    for url, (response, error) in zip(urls, results):
         if error is not None:
             errors.append(error)
 
         if response is not None and response.status_code == 200:
-            if response.text:
+            if response.content:
                 try:
                     logger.debug(f"Loading from {url}")
-                    configure_errors = json.loads(response.text)
+                    configure_errors = json.loads(response.content)
                 except JSONDecodeError as e:
                     logger.info(f"Couldn't load configure response:\n{e}")
                     logger.debug(f"{url} returned {response.text}")
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.3 on 2026-10-15 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builder', '0016_courseupdate_commit_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='courseupdate',
+            index=models.Index(fields=['course', '-request_time'], name='builder_cou_course__a69349_idx'),
+        ),
+    ]
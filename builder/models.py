@@ -85,6 +85,9 @@ class CourseUpdate(models.Model):
 
     class Meta:
         ordering = ['-request_time']
+        indexes = [
+            models.Index(fields=['course', '-request_time']),
+        ]
 
     def __str__(self) -> str:
         return f"Course: {self.course.key} {self.status} {self.request_ip}, requested: {self.request_time}, updated: {self.updated_time}"
@@ -1,6 +1,7 @@
 from inspect import FullArgSpec, getfullargspec
 import os.path
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from typing import Any, Dict
 from unittest.mock import Mock, patch
 import urllib.parse
@@ -8,11 +9,12 @@ import urllib.parse
 from django.conf import settings
 from django.test import TestCase, override_settings
 
-from .builder import build_course, build_module
+from .builder import build_course, build_module, is_self_contained, store
 from .models import Course, CourseUpdate
 from access.config import CourseConfig, ConfigSource
 from util.git import get_diff_names
 from util.files import rm_path
+from util.perfmonitor import PerfMonitor
 
 
 test_course_commits = [
@@ -38,80 +40,91 @@ def get_args(argspec: FullArgSpec, mock: Mock, index: int = -1):
     STATIC_CONTENT_HOST="http://example.com",
 )
 class BuildTest(TestCase):
-    def setUp(self):
-        self.course_key = "test_course"
-        self.course = Course(
-            key=self.course_key,
+    BUILD_ARGSPEC = getfullargspec(build_module.build)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course_key = "test_course"
+        cls.static_url_path = os.path.join(settings.STATIC_URL, cls.course_key)
+        cls.course = Course(
+            key=cls.course_key,
             git_origin="dummyurl",
         )
-        self.course.save()
+        cls.course.save()
 
         for path in (settings.BUILD_PATH, settings.STORE_PATH):
             if not os.path.exists(path):
                 os.mkdir(path)
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The mocks are created once and reset before each test
+        patches = {
+            "build_mock": patch("builder.builder.build_module.build"),
+            "checkout_mock": patch("builder.builder.checkout"),
+            "clean_mock": patch("builder.builder.clean"),
+            "configure_mock": patch("builder.builder.configure_graders"),
+        }
+        for name, p in patches.items():
+            setattr(cls, name, p.start())
+            cls.addClassCleanup(p.stop)
+
+    def setUp(self) -> None:
+        for mock in (self.build_mock, self.checkout_mock, self.clean_mock, self.configure_mock):
+            mock.reset_mock()
+        self.build_mock.return_value = True
+        self.checkout_mock.return_value = True
+        self.clean_mock.return_value = True
+        self.configure_mock.return_value = ({}, [])
+
     def tearDown(self) -> None:
-        self.course.delete()
         rm_path(CourseConfig.version_id_path(self.course_key, source=ConfigSource.BUILD))
 
     def test_changed_files(self) -> None:
         build_dir = CourseConfig.path_to(self.course_key, source=ConfigSource.BUILD)
-        static_url_path = os.path.join(settings.STATIC_URL, self.course_key)
-
-        build_argspec = getfullargspec(build_module.build)
-
-        with patch("builder.builder.build_module.build") as build_mock, \
-                patch("builder.builder.checkout") as checkout_mock, \
-                patch("builder.builder.clean") as clean_mock, \
-                patch("builder.builder.configure_graders") as configure_mock:
-
-            build_mock.return_value = True
-            checkout_mock.return_value = True
-            clean_mock.return_value = True
-            configure_mock.return_value = ({}, [])
-
-
-            update = self.build_course()
-            self.assertEqual(update.status, CourseUpdate.Status.SUCCESS)
-            self.assertEqual(update.commit_hash, test_course_commits[-1])
-
-            expected_build_args = {
-                "course_key": self.course_key,
-                "path": Path(build_dir),
-                "image": "testimage",
-                "cmd": ["testcommand"],
-                "env": {
-                    "COURSE_KEY": self.course_key,
-                    "COURSE_ID": "None",
-                    "STATIC_URL_PATH": static_url_path,
-                    "STATIC_CONTENT_HOST": urllib.parse.urljoin(settings.STATIC_CONTENT_HOST, static_url_path),
-                    "CHANGED_FILES": {"*"},
-                },
-                "settings": settings.BUILD_MODULE_SETTINGS,
-            }
-            self.assert_args(expected_build_args, get_args(build_argspec, build_mock))
-
-
-            CourseUpdate(
-                course=self.course,
-                request_ip="0.0.0.0",
-                status=CourseUpdate.Status.SUCCESS,
-                commit_hash=test_course_commits[0],
-            ).save()
-
-            CourseUpdate(
-                course=self.course,
-                request_ip="0.0.0.0",
-                status=CourseUpdate.Status.FAILED,
-                commit_hash=test_course_commits[1],
-            ).save()
-
-            update = self.build_course()
-            self.assertEqual(update.status, CourseUpdate.Status.SUCCESS)
-            self.assertEqual(update.commit_hash, test_course_commits[-1])
-
-            expected_build_args["env"]["CHANGED_FILES"] = {"index.yaml", "apps.meta"}
-            self.assert_args(expected_build_args, get_args(build_argspec, build_mock))
+
+        update = self.build_course()
+        self.assertEqual(update.status, CourseUpdate.Status.SUCCESS)
+        self.assertEqual(update.commit_hash, test_course_commits[-1])
+
+        expected_build_args = {
+            "course_key": self.course_key,
+            "path": Path(build_dir),
+            "image": "testimage",
+            "cmd": ["testcommand"],
+            "env": {
+                "COURSE_KEY": self.course_key,
+                "COURSE_ID": "None",
+                "STATIC_URL_PATH": self.static_url_path,
+                "STATIC_CONTENT_HOST": urllib.parse.urljoin(settings.STATIC_CONTENT_HOST, self.static_url_path),
+                "CHANGED_FILES": {"*"},
+            },
+            "settings": settings.BUILD_MODULE_SETTINGS,
+        }
+        self.assert_args(expected_build_args, get_args(self.BUILD_ARGSPEC, self.build_mock))
+
+
+        CourseUpdate(
+            course=self.course,
+            request_ip="0.0.0.0",
+            status=CourseUpdate.Status.SUCCESS,
+            commit_hash=test_course_commits[0],
+        ).save()
+
+        CourseUpdate(
+            course=self.course,
+            request_ip="0.0.0.0",
+            status=CourseUpdate.Status.FAILED,
+            commit_hash=test_course_commits[1],
+        ).save()
+
+        update = self.build_course()
+        self.assertEqual(update.status, CourseUpdate.Status.SUCCESS)
+        self.assertEqual(update.commit_hash, test_course_commits[-1])
+
+        expected_build_args["env"]["CHANGED_FILES"] = {"index.yaml", "apps.meta"}
+        self.assert_args(expected_build_args, get_args(self.BUILD_ARGSPEC, self.build_mock))
 
     def build_course(self, *args, **kwargs) -> CourseUpdate:
         update = CourseUpdate(
@@ -135,3 +148,54 @@ class BuildTest(TestCase):
                 self.assertEqual(v, {f for f in args[k].split("\n") if f}, f"k = {k}")
             else:
                 self.assertEqual(v, args[k], f"k = {k}")
+
+
+class StoreTest(TestCase):
+    def setUp(self) -> None:
+        self.course_key = "test_course"
+        self.store_dir = TemporaryDirectory()
+        self.addCleanup(self.store_dir.cleanup)
+
+        p = patch("builder.builder.configure_graders", return_value=({}, []))
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_store(self) -> None:
+        with override_settings(
+            BUILD_PATH=os.path.abspath(os.path.join(settings.TESTDATADIR, "build")),
+            STORE_PATH=self.store_dir.name,
+            GIT_OPTIONS=["--git-dir", "dotgit"],
+        ):
+            config = CourseConfig.load(self.course_key, source=ConfigSource.BUILD)
+            self.assertTrue(store(PerfMonitor(), config))
+
+            store_path = CourseConfig.path_to(self.course_key, source=ConfigSource.STORE)
+            for file in ("index.yaml", "apps.meta", "arithmetic_mcq.yaml", "hello_python/config.yaml", "static/chapter.html"):
+                self.assertTrue(os.path.isfile(os.path.join(store_path, file)), file)
+
+            self.assertTrue(os.path.isfile(CourseConfig.defaults_path(self.course_key, source=ConfigSource.STORE)))
+
+
+class SelfContainedTest(TestCase):
+    def test_is_self_contained(self) -> None:
+        with TemporaryDirectory() as tmp:
+            course_dir = os.path.join(tmp, "course")
+            os.makedirs(os.path.join(course_dir, "dir"))
+            Path(course_dir, "dir", "file").touch()
+            Path(tmp, "outside").touch()
+            os.symlink("file", os.path.join(course_dir, "dir", "relative"))
+
+            self.assertEqual(is_self_contained(course_dir), (True, None))
+
+            link = os.path.join(course_dir, "dir", "link")
+
+            os.symlink(os.path.join(course_dir, "dir", "file"), link)
+            value, error = is_self_contained(course_dir)
+            self.assertFalse(value)
+            self.assertIn("absolute symlink", error)
+            os.unlink(link)
+
+            os.symlink("../../outside", link)
+            value, error = is_self_contained(course_dir)
+            self.assertFalse(value)
+            self.assertIn("outside the course directory", error)
@@ -3,7 +3,7 @@
 # You should create local_settings.py and override any settings there.
 # You can copy local_settings.example.py and start from there.
 ##
-from os import environ
+from os import cpu_count, environ
 from os.path import abspath, dirname, join
 from typing import Any, Dict
 BASE_DIR = dirname(dirname(abspath(__file__)))
@@ -47,6 +47,7 @@ APLUS_AUTH_LOCAL = {
 DEFAULT_IMAGE="apluslms/compile-rst:1.6"
 # default command passed to container. set to None to use the image default
 DEFAULT_CMD="legacy_build"
+# path to a .py file or a dotted module name
 BUILD_MODULE = join(BASE_DIR, "scripts/docker_build.py")
 
 # Course configuration path:
@@ -78,6 +79,16 @@ ENABLE_PERFORMANCE_MONITORING = False
 
 BUILD_RETRY_DELAY = 30
 
+# Maximum number of log records kept in a course update log. The first and the latest half
+# are kept and the records in between are dropped.
+BUILD_LOG_MAX_RECORDS = 10000
+
+# Whether to load the exercise configs of a course in parallel using a thread pool
+PARALLEL_COURSE_LOAD = True
+
+# Maximum number of services that are configured or published in parallel
+CONFIGURE_MAX_WORKERS = 8
+
 APLUS_AUTH: Dict[str, Any] = {
     "UID": "gitmanager",
     "AUTH_CLASS": "access.auth.Authentication",
@@ -212,6 +223,11 @@ APLUS_JSON_FILELOCK_TIMEOUT = 30
 
 # Extra options applied to all git commands
 GIT_OPTIONS = []
+# Number of submodules fetched in parallel when cloning and updating course repositories
+GIT_SUBMODULE_JOBS = min(8, cpu_count() or 1)
+# Object filter for cloning course repositories, e.g. "blob:none" for a partial clone that
+# only downloads the file contents of the checked out commits. None clones everything
+GIT_CLONE_FILTER = None
 
 # Personalized exercises are kept in this directory (relative to the course git repository root).
 # This value should be identical to the value of settings.PERSONALIZED_CONTENT_DIR in MOOC-Grader.
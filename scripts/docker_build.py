@@ -3,15 +3,133 @@ If the app runs inside docker, BUILD_PATH and COURSES_PATH must be mounted to a
 Inside BUILD_MODULE_SETTINGS, set CONTAINER_BUILD_PATH to BUILD_PATH, CONTAINER_PUBLISH_PATH to COURSES_PATH,
 HOST_BUILD_PATH to the directory where BUILD_PATH is on host and HOST_PUBLISH_PATH to the directory where
 COURSES_PATH is on host. This is so that we can call docker and mount said directory to the build container.
+
+By default, every build runs in a new container that is removed afterwards. Set REUSE_CONTAINERS to True
+inside BUILD_MODULE_SETTINGS to keep the build container of a course running between builds and run
+the build command in it with docker exec. This avoids the container start up cost on every build, but
+files outside /content, installed packages and background processes carry over to the next build of
+the course. The container is recreated if the image changes or a build fails, and the containers are
+removed when the process exits. The image must contain the sleep command.
 """
 
+import atexit
+import hashlib
+from itertools import chain
+import json
 import logging
 import os.path
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
 import subprocess
 
 
+# Label used to find the build containers started by this module
+CONTAINER_LABEL = "gitmanager.builder"
+
+# Maps (image, host path) to the name of the running build container
+_builders: Dict[Tuple[str, str], str] = {}
+_builders_lock = Lock()
+
+
+def _docker(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ["docker", *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding='utf8',
+    )
+
+
+def _inspect_image(logger: logging.Logger, image: str) -> Optional[Dict[str, Any]]:
+    process = _docker("image", "inspect", image)
+    if process.returncode != 0:
+        # docker run would pull the image automatically, so do the same here
+        logger.info(_docker("pull", image).stdout)
+        process = _docker("image", "inspect", image)
+        if process.returncode != 0:
+            logger.info(process.stdout)
+            return None
+
+    return json.loads(process.stdout)[0]
+
+
+def _is_running(name: str) -> bool:
+    process = _docker("container", "inspect", "--format", "{{.State.Running}}", name)
+    return process.returncode == 0 and process.stdout.strip() == "true"
+
+
+def _ensure_builder(logger: logging.Logger, image_id: str, host_path: str) -> Optional[str]:
+    """
+    Returns the name of a running build container for the image with the
+    host path mounted to /content, starting one if necessary.
+    Returns None if the container could not be started.
+    """
+    name = "gitmanager-builder-" + hashlib.sha256(f"{image_id}:{host_path}".encode()).hexdigest()[:16]
+    if _is_running(name):
+        return name
+
+    # Remove the containers of older images and any stopped container with the same name
+    stale = _docker("ps", "-aq", "--filter", f"label={CONTAINER_LABEL}={host_path}").stdout.split()
+    if stale:
+        _docker("rm", "-f", *stale)
+
+    process = _docker(
+        "run", "-d",
+        "--name", name,
+        "--label", f"{CONTAINER_LABEL}={host_path}",
+        "-v", f"{host_path}:/content",
+        "--workdir", "/content",
+        "--entrypoint", "sleep",
+        image_id, "infinity",
+    )
+    if process.returncode != 0:
+        logger.info(process.stdout)
+        return None
+
+    return name
+
+
+@atexit.register
+def _remove_builders() -> None:
+    with _builders_lock:
+        names = list(_builders.values())
+        _builders.clear()
+    if names:
+        _docker("rm", "-f", *names)
+
+
+def _remove_builder(image: str, host_path: str) -> None:
+    with _builders_lock:
+        name = _builders.pop((image, host_path), None)
+        if name is not None:
+            _docker("rm", "-f", name)
+
+
+def _exec_command(
+        logger: logging.Logger,
+        image: str,
+        host_path: str,
+        cmd: Optional[List[str]],
+        env_args: List[str],
+        ) -> Optional[List[str]]:
+    config = _inspect_image(logger, image)
+    if config is None:
+        return None
+
+    with _builders_lock:
+        name = _ensure_builder(logger, config["Id"], host_path)
+        if name is None:
+            return None
+        _builders[(image, host_path)] = name
+
+    if cmd is None:
+        # Run what docker run would run by default
+        cmd = (config["Config"].get("Entrypoint") or []) + (config["Config"].get("Cmd") or [])
+
+    return ["docker", "exec", "-w", "/content", *env_args, name, *cmd]
+
+
 def build(
         logger: logging.Logger,
         path: Path,
@@ -21,7 +139,7 @@ def build(
         settings: Dict[str, Any],
         **kwargs,
         ) -> bool:
-    env_args = [i for t in (("-e", f"{k}={v}") for k,v in env.items()) for i in t]
+    env_args = list(chain.from_iterable(("-e", f"{k}={v}") for k, v in env.items()))
     if str(path).startswith(settings["CONTAINER_BUILD_PATH"]):
         host_path = str(path).replace(settings["CONTAINER_BUILD_PATH"], settings["HOST_BUILD_PATH"])
     elif str(path).startswith(settings["CONTAINER_PUBLISH_PATH"]):
@@ -29,25 +147,41 @@ def build(
     else:
         raise Exception("Couldn't determine path on host. Check the BUILD_MODULE_SETTINGS in (local_)settings.py")
 
-    command = [
-        "docker", "run",
-        *env_args,
-        "--rm",
-        "-v", f"{host_path}:/content",
-        "--workdir", "/content",
-        image,
-    ]
+    reuse_container = settings.get("REUSE_CONTAINERS", False)
+    if reuse_container:
+        command = _exec_command(logger, image, host_path, cmd, env_args)
+        if command is None:
+            return False
+    else:
+        command = [
+            "docker", "run",
+            *env_args,
+            "--rm",
+            "-v", f"{host_path}:/content",
+            "--workdir", "/content",
+            image,
+        ]
 
-    if cmd is not None:
-        command.extend(cmd)
+        if cmd is not None:
+            command.extend(cmd)
 
     logger.info(" ".join(command))
 
-    process = subprocess.run(
+    # Log the output line by line as it comes so that the build progress can be followed
+    with subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         encoding='utf8',
-    )
-    logger.info(process.stdout)
-    return process.returncode == 0
+        errors='replace',
+        bufsize=1,
+    ) as process:
+        for line in process.stdout:
+            logger.info(line.rstrip("\n"))
+        returncode = process.wait()
+
+    if returncode != 0 and reuse_container:
+        # Don't let a failed build leave anything behind for the next build
+        _remove_builder(image, host_path)
+
+    return returncode == 0
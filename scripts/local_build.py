@@ -13,9 +13,10 @@ def build(
     success = True
     def run(command, **kwargs):
         nonlocal success, env
-        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf8', env=env, **kwargs)
-        logger.info(process.stdout + "\n")
-        success = success and process.returncode == 0
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf8', errors='replace', bufsize=1, env=env, **kwargs) as process:
+            for line in process.stdout:
+                logger.info(line.rstrip("\n"))
+            success = success and process.wait() == 0
 
     if Path(path, "build.sh").exists():
         logger.info("### Detected 'build.sh' executing it with bash. ###\n")
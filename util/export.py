@@ -179,7 +179,8 @@ def form_fields(languages, exercises):
 
         if 'extra_info' in f:
             es = list_get(fs, 'extra_info', {})
-            extra = es[0]
+            # copy so that the exercise config itself is not modified
+            extra = dict(es[0])
             for key in ['validationMessage']:
                 if key in extra:
                     extra[key] = i18n_map(list_get(es, key, ''))
@@ -2,16 +2,20 @@
 Utility functions for exercise files.
 
 '''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
+import errno
 import fcntl
-from pathlib import Path
+from pathlib import Path, PurePath
 import os
 import shutil
+import stat
 import subprocess
 import tempfile
 import time
 from types import TracebackType
-from typing import Dict, Generator, Iterable, List, Optional, Set, Tuple, Type, Union
+from typing import Any, Deque, Dict, Generator, Iterable, List, Optional, Set, Tuple, Type, Union
 
 from django.conf import settings
 from django.http.response import FileResponse as DjangoFileResponse, HttpResponse
@@ -20,6 +24,15 @@ from huey.contrib.djhuey import task
 from util.typing import PathLike
 
 
+# Maximum number of bytes copied with a single copy_file_range call
+COPY_CHUNK_SIZE = 1 << 30
+# Maximum number of threads used to copy the files of a directory tree
+COPY_MAX_WORKERS = 8
+# Minimum and maximum time in seconds between attempts to acquire a FileLock with a timeout
+LOCK_POLL_MIN_DELAY = 0.01
+LOCK_POLL_MAX_DELAY = 1
+
+
 def read_meta(file_path: PathLike) -> Dict[str,str]:
     '''
     Reads a meta file comprised of lines in format: key = value.
@@ -32,50 +45,43 @@ def read_meta(file_path: PathLike) -> Dict[str,str]:
     meta: Dict[str,str] = {}
     if os.path.exists(file_path):
         with open(file_path, 'r') as f:
-            for key,val in [l.split('=') for l in f.readlines() if '=' in l]:
-                meta[key.strip()] = val.strip()
+            for line in f.read().splitlines():
+                key, sep, val = line.partition('=')
+                if sep:
+                    meta[key.strip()] = val.strip()
     return meta
 
 
 def rm_path(path: Union[str, Path]) -> None:
-    path = Path(path)
-    if path.is_symlink():
-        path.unlink()
-    elif not path.exists():
+    path = os.fspath(path)
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
         return
-    elif path.is_dir():
+
+    if stat.S_ISDIR(mode):
         shutil.rmtree(path)
     else:
-        path.unlink()
+        os.unlink(path)
 
 
 def rm_paths(paths: Iterable[Union[str, Path]]) -> None:
-    for path in paths:
-        if path is not None:
-            rm_path(path)
-
-
-def rm_except(dir: PathLike, exclude: PathLike) -> None:
-    """Remove directory contents except for <exclude>"""
-    def inner(dir: PathLike, exclude: PathLike, exclude_parents: Set[str]):
-        with os.scandir(dir) as it:
-            for direntry in it:
-                if exclude == direntry.path:
-                    continue
-                elif direntry.path in exclude_parents:
-                    inner(direntry.path, exclude, exclude_parents)
-                elif direntry.is_symlink():
-                    Path(direntry.path).unlink()
-                elif direntry.is_dir():
-                    shutil.rmtree(direntry.path)
-                else:
-                    Path(direntry.path).unlink()
-
-    if not os.path.exists(dir):
+    """
+    Removes the paths with a single rm command. Missing paths are ignored and
+    symlinks are removed without touching their targets, like in rm_path.
+    """
+    paths = [os.fspath(path) for path in paths if path is not None]
+    if not paths:
         return
 
-    exclude_parents = {str(p) for p in Path(exclude).parents}
-    inner(dir, exclude, exclude_parents)
+    process = subprocess.run(
+        ["rm", "-rf", "--", *paths],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding="utf-8"
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"Failed to remove paths: {process.stdout}")
 
 
 @task(retries=2, retry_delay=3)
@@ -90,8 +96,10 @@ def copys_async(
         *,
         read_lock_path: Optional[PathLike] = None,
         write_lock_path: Optional[PathLike] = None,
+        link_files: bool = False,
         ) -> None:
     """Copies a list of files and directories asynchronously.
+    See copytree for <link_files>.
 
     Note that the copying might fail, and the caller wont know about it
     due to the asynchronousity"""
@@ -102,14 +110,20 @@ def copys_async(
             stack.enter_context(FileLock(read_lock_path))
         for src, dst in pairs:
             if os.path.isdir(src):
-                copytree(src, dst)
+                copytree(src, dst, link_files=link_files)
             else:
                 copyfile(src, dst)
 
 
-def rsync(src: PathLike, dst: PathLike) -> int:
+def rsync(src: PathLike, dst: PathLike, link_dest: Optional[PathLike] = None, preserve_attributes: bool = False) -> int:
     """
     Uses rsync command to copy a directory tree for speed and to preserve hard- and symlinks.
+
+    If <link_dest> is a directory, files in it that are identical to the ones in <src> are
+    hard linked to <dst> instead of copied. <link_dest> must be on the same device as <dst>.
+
+    If <preserve_attributes> is True, the permissions and modification times are copied too,
+    like shutil.copy2 does.
     """
     src, dst = os.fspath(src), os.fspath(dst)
     if not os.path.isdir(src):
@@ -120,8 +134,14 @@ def rsync(src: PathLike, dst: PathLike) -> int:
     if dst[-1] != "/":
         dst = dst + "/"
 
+    options = []
+    if link_dest is not None and os.path.isdir(link_dest):
+        options = ["--link-dest", os.path.abspath(link_dest)]
+    if preserve_attributes:
+        options.append("-pt")
+
     process = subprocess.run(
-        ["rsync", "-crlH", "--delete", "--out-format", "%n", os.fspath(src), os.fspath(dst)],
+        ["rsync", "-crlH", "--delete", *options, "--out-format", "%n", os.fspath(src), os.fspath(dst)],
         #["rsync", "-trlH", "--delete-excluded", "--include-from", "-", "--exclude", "**", "--out-format", "%n", os.fspath(src), os.fspath(dst)],
         #input="\n".join("/" + f for f in files),
         #text=True,
@@ -135,23 +155,114 @@ def rsync(src: PathLike, dst: PathLike) -> int:
     return process.stdout.count("\n")
 
 
+def copy_files(src: PathLike, dst: PathLike, files: Iterable[str]) -> None:
+    """
+    Copies <files> (paths relative to <src>) to the same paths under <dst>.
+    Missing parent directories are created. Like copyfile, symlinks are copied as the files they point to,
+    and the permissions and modification times are preserved.
+    """
+    src, dst = os.fspath(src), os.fspath(dst)
+    created_dirs: Set[str] = set()
+    for file in files:
+        target = os.path.join(dst, file)
+        parent = os.path.dirname(target)
+        if parent not in created_dirs:
+            os.makedirs(parent, exist_ok=True)
+            created_dirs.add(parent)
+        copyfile(os.path.join(src, file), target)
+
+
+def _copy_fd(src_fd: int, dst_fd: int) -> None:
+    """
+    Copies the rest of <src_fd> to <dst_fd> using copy_file_range so that the data stays
+    in the kernel (or is reflinked if the filesystem supports it). Falls back to a
+    normal copy if copy_file_range isn't supported for the file descriptors.
+    """
+    copied = 0
+    while True:
+        try:
+            n = os.copy_file_range(src_fd, dst_fd, COPY_CHUNK_SIZE)
+        except OSError as e:
+            # Cross-filesystem copies are not supported by older kernels, and
+            # some filesystems do not support the call at all
+            if copied > 0 or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            with open(src_fd, "rb", closefd=False) as fsrc, open(dst_fd, "wb", closefd=False) as fdst:
+                shutil.copyfileobj(fsrc, fdst)
+            return
+        if n == 0:
+            return
+        copied += n
+
+
 def copyfile(src: PathLike, dst: PathLike) -> None:
-    shutil.copyfile(src, dst)
+    """
+    Copies a file with its permissions and modification time. An existing <dst> is
+    replaced instead of written over so that other hard links to it are not modified.
+    """
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        _copy_fd(fsrc.fileno(), fdst.fileno())
     shutil.copystat(src, dst)
 
 
-def copytree(src: PathLike, dst: PathLike) -> None:
+def copytree(src: PathLike, dst: PathLike, link_files: bool = False) -> None:
     """
-    Uses cp command to copy a directory tree in order to preserve hard- and symlinks.
+    Copies a directory tree to <dst> (which must not exist) while preserving hard- and symlinks,
+    permissions and modification times.
+
+    If <link_files> is True and <dst> is on the same device as <src>, the files are hard linked
+    to the ones in <src> instead of copied. Neither copy may then be modified in place.
     """
-    process = subprocess.run(
-        ["cp", "-a", os.fspath(src), os.fspath(dst)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        encoding="utf-8"
-    )
-    if process.returncode != 0:
-        raise RuntimeError(f"Failed to copy built course files: {process.stdout}")
+    src, dst = os.fspath(src), os.fspath(dst)
+    link_files = link_files and os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+    # (st_dev, st_ino) -> the first copy of a file with multiple hard links
+    links: Dict[Tuple[int, int], str] = {}
+    # (src, dst) pairs of the files to copy, hard links to create and directories to copy metadata of
+    files: List[Tuple[str, str]] = []
+    hard_links: List[Tuple[str, str]] = []
+    dirs: List[Tuple[str, str]] = []
+
+    stack = [(src, dst)]
+    while stack:
+        dir_src, dir_dst = stack.pop()
+        os.mkdir(dir_dst)
+        dirs.append((dir_src, dir_dst))
+        with os.scandir(dir_src) as it:
+            for entry in it:
+                target = os.path.join(dir_dst, entry.name)
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), target)
+                    shutil.copystat(entry.path, target, follow_symlinks=False)
+                elif entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, target))
+                elif link_files:
+                    os.link(entry.path, target)
+                else:
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_nlink > 1:
+                        key = (st.st_dev, st.st_ino)
+                        if key in links:
+                            hard_links.append((links[key], target))
+                            continue
+                        links[key] = target
+                    files.append((entry.path, target))
+
+    # Copy the files in parallel so that the waits for the disk overlap
+    if files:
+        with ThreadPoolExecutor(max_workers=min(COPY_MAX_WORKERS, len(files))) as executor:
+            for _ in executor.map(lambda pair: copyfile(*pair), files):
+                pass
+
+    for link_src, target in hard_links:
+        os.link(link_src, target)
+
+    # Copied last (and children first) so that the directory modification times aren't changed by the copying
+    for dir_src, dir_dst in reversed(dirs):
+        shutil.copystat(dir_src, dir_dst)
 
 
 def is_subpath(child: PathLike, parent: Optional[PathLike] = None) -> bool:
@@ -181,51 +292,84 @@ def file_mappings(root: Path, mappings_in: Iterable[Tuple[str,str]]) -> Generato
 
     Raises ValueError if a name has multiple different files.
     """
-    mappings = sorted((name, root / path) for name, path in mappings_in)
-
-    def in_course_dir_check(path: Path):
-        nonlocal root
-        try:
-            path.resolve().relative_to(root)
-        except:
+    # A tree of the mapped names: each node is a (paths mapped to the name, child nodes) tuple
+    MappingNode = Tuple[List[Path], Dict[str, Any]]
+    tree: MappingNode = ([], {})
+    for name, path in mappings_in:
+        node = tree
+        for part in PurePath(name).parts:
+            node = node[1].setdefault(part, ([], {}))
+        node[0].append(root / path)
+
+    root_str = os.path.realpath(root)
+    # Paths that are already known to be inside the course directory
+    verified: Set[Path] = set()
+
+    def in_course_dir_check(path: PathLike):
+        nonlocal root_str
+        if not is_subpath(os.path.realpath(path), root_str):
             raise ValueError(f"{path} links outside the course directory")
 
-    def expand_dir(name: str, path: Path) -> Generator[Tuple[str,Path], None, None]:
-        for child in path.iterdir():
-            child_name = name / child.relative_to(path)
-            yield str(child_name), child
-
     def expand_full(name: str, path: Path) -> Generator[Tuple[str,Path], None, None]:
         if path.is_file():
-            in_course_dir_check(path)
+            if path not in verified:
+                in_course_dir_check(path)
             yield name, path
         elif path.is_dir():
-            for root, _, files in os.walk(path, followlinks=True):
-                root = Path(root)
-                rootname = name / root.relative_to(path)
-                for file in files:
-                    in_course_dir_check(root / file)
-                    yield str(rootname / file), root / file
-
-    while mappings:
-        while len(mappings) > 1 and is_subpath(mappings[1][0], mappings[0][0]):
-            map = mappings.pop(0)
-            if map[1].is_file():
-                if map[0] != mappings[0][0]:
-                    raise ValueError(f"{map[0]} is mapped to a file ({map[1]}) but {mappings[0][0]} is under it")
-                elif map[1] != mappings[0][1]:
-                    raise ValueError(f"{map[0]} is mapped to a file {map[1]} and the path {mappings[0][1]}")
-            elif map[1].is_dir():
-                mappings.extend(expand_dir(*map))
-                mappings.sort()
-
-
-        if not is_subpath(str(mappings[0][1]), str(root)):
-            raise ValueError(f"{mappings[0][0]} is mapped to a file ({mappings[0][1]}) outside the root ({root})")
-        elif os.path.isabs(mappings[0][0]):
-            raise ValueError(f"tar filename {mappings[0][0]} is absolute")
-
-        yield from expand_full(*mappings.pop(0))
+            if path not in verified:
+                in_course_dir_check(path)
+            # Join the names as strings, only the mapped name needs to be normalized
+            name = str(PurePath(name))
+            prefix = "" if name == "." else name + "/"
+            stack: Deque[Tuple[str, str]] = deque([(prefix, os.fspath(path))])
+            while stack:
+                prefix, dirpath = stack.pop()
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        # Only symlinks need to be checked inside the directory: everything else
+                        # is inside the course directory if the directory containing it is
+                        if entry.is_symlink():
+                            in_course_dir_check(entry.path)
+                        entryname = prefix + entry.name
+                        if entry.is_dir():
+                            stack.append((entryname + "/", entry.path))
+                        else:
+                            yield entryname, Path(entry.path)
+
+    def resolve(name: PurePath, node: MappingNode) -> Generator[Tuple[str,Path], None, None]:
+        paths, children = node
+        paths = sorted(set(paths))
+        if len(paths) > 1 or children:
+            # Multiple paths are mapped to the name or to names under it: merge the
+            # directories into the child nodes. Missing paths are ignored.
+            for path in paths:
+                if path.is_file():
+                    other = next((p for p in paths if p != path), None)
+                    if other is not None:
+                        raise ValueError(f"{name} is mapped to a file {path} and the path {other}")
+                    raise ValueError(f"{name} is mapped to a file ({path}) but {name / min(children)} is under it")
+                elif path.is_dir():
+                    # Entries that aren't symlinks are inside the course directory if the directory is
+                    if path not in verified:
+                        in_course_dir_check(path)
+                    with os.scandir(path) as it:
+                        for entry in it:
+                            entry_path = Path(entry.path)
+                            if not entry.is_symlink():
+                                verified.add(entry_path)
+                            children.setdefault(entry.name, ([], {}))[0].append(entry_path)
+
+            for child in sorted(children):
+                yield from resolve(name / child, children[child])
+        elif paths:
+            if not is_subpath(str(paths[0]), str(root)):
+                raise ValueError(f"{name} is mapped to a file ({paths[0]}) outside the root ({root})")
+            elif os.path.isabs(name):
+                raise ValueError(f"tar filename {name} is absolute")
+
+            yield from expand_full(str(name), paths[0])
+
+    yield from resolve(PurePath(), tree)
 
 
 def _tmp_path(path) -> str:
@@ -250,6 +394,10 @@ def rename(src: PathLike, dst: PathLike, keep_tmp=False) -> Optional[str]:
     tmpdst = None
 
     src, dst = os.fspath(src), os.fspath(dst)
+    if not keep_tmp and not os.path.lexists(dst):
+        os.rename(src, dst)
+        return None
+
     if not os.path.exists(dst) or (os.path.isfile(dst) and os.path.isfile(src)):
         if keep_tmp and os.path.exists(dst):
             tmpdst = _tmp_path(dst)
@@ -301,13 +449,6 @@ def readfile(path: PathLike) -> str:
         return file.read()
 
 
-def _try_lockf(lockfile, flags) -> Optional[OSError]:
-    try:
-        fcntl.lockf(lockfile, flags)
-    except OSError as e:
-        return e
-    return None
-
 class FileLock:
     """
     A context manager for acquiring a file lock on a file or directory.
@@ -325,16 +466,20 @@ class FileLock:
         if self.timeout is None:
             fcntl.lockf(self.lockfile, self.lock_flag)
         else:
-            # we would use a signal to timeout but it can only be used on the main thread
-            e = _try_lockf(self.lockfile, self.lock_flag | fcntl.LOCK_NB)
-            if e:
-                for _ in range(self.timeout):
-                    time.sleep(1)
-                    e = _try_lockf(self.lockfile, self.lock_flag | fcntl.LOCK_NB)
-                    if not e:
-                        break
-                else:
-                    raise e
+            # we would use a signal to timeout but it can only be used on the main thread.
+            # Poll with an exponential backoff so that short waits don't take a full second
+            deadline = time.monotonic() + self.timeout
+            delay = LOCK_POLL_MIN_DELAY
+            while True:
+                try:
+                    fcntl.lockf(self.lockfile, self.lock_flag | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, LOCK_POLL_MAX_DELAY)
 
         return self.lockfile
 
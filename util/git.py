@@ -1,8 +1,14 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger, getLogger
 from pathlib import Path
 import os
+import shutil
 import subprocess
-from typing import List, Optional, Tuple
+from threading import Lock
+from types import TracebackType
+from typing import List, Optional, Tuple, Type
+from weakref import WeakValueDictionary
 
 from django.conf import settings
 
@@ -12,13 +18,30 @@ from util.typing import PathLike
 
 default_logger = getLogger("util.git")
 
-# Copy the environment for use in git calls. In particular, the HOME variable is needed to find the .gitconfig file
-# in case it contains something necessary (like safe.directories)
+# The git executable. A full path lets subprocess start the local read-only commands with posix_spawn
+# (see git_call)
+GIT = shutil.which("git") or "git"
+
+# Copy the environment for use in git calls that contact the remote (see git_call). In particular, the HOME variable
+# is needed to find the .gitconfig file in case it contains something necessary (like safe.directories)
 git_env = os.environ.copy()
 git_env["GIT_SSH_COMMAND"] = f"ssh -i {settings.SSH_KEY_PATH}"
 
 
-def git_call(path: str, command: str, cmd: List[str], include_cmd_string: bool = True) -> Tuple[bool, str]:
+def git_call(path: str, command: str, cmd: List[str], include_cmd_string: bool = True, input: Optional[str] = None, needs_ssh: bool = False, merge_stderr: bool = True, local_read: bool = False) -> Tuple[bool, str]:
+    """
+    Runs git <cmd> in <path>. Set <needs_ssh> for commands that may contact the remote: only they
+    get the environment with GIT_SSH_COMMAND, the rest inherit the environment of this process.
+
+    With <merge_stderr> the output includes stderr interleaved with stdout, which is what the build
+    log wants. Commands whose output is parsed should set it to False: stderr is then read from
+    a separate pipe and only included in the error message.
+
+    Set <local_read> for read-only commands that don't contact the remote. They are started with
+    close_fds=False, which lets subprocess use the faster posix_spawn. The file descriptors opened by
+    Python are not inheritable (PEP 446) anyway, but the other commands (which may start ssh)
+    get every descriptor closed to be safe.
+    """
     global git_env
 
     if include_cmd_string:
@@ -26,17 +49,105 @@ def git_call(path: str, command: str, cmd: List[str], include_cmd_string: bool =
     else:
         cmd_str = ""
 
-    response = subprocess.run(["git", "-C", path, *settings.GIT_OPTIONS] + cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8', env=git_env)
+    response = subprocess.run(
+        [GIT, "-C", path, *settings.GIT_OPTIONS] + cmd,
+        input=input.encode("utf-8") if input is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE,
+        env=git_env if needs_ssh else None,
+        close_fds=not local_read,
+    )
+    # Decoded once here. Invalid UTF-8 (e.g. in file names or commit messages) is replaced instead of raising
+    stdout = response.stdout.decode("utf-8", "replace")
     if response.returncode != 0:
-        return False, f"{cmd_str}Git {command}: returncode: {response.returncode}\nstdout: {response.stdout}\n"
+        if merge_stderr:
+            return False, f"{cmd_str}Git {command}: returncode: {response.returncode}\nstdout: {stdout}\n"
+        stderr = response.stderr.decode("utf-8", "replace")
+        return False, f"{cmd_str}Git {command}: returncode: {response.returncode}\nstdout: {stdout}\nstderr: {stderr}\n"
 
-    return True, cmd_str + response.stdout
+    return True, cmd_str + stdout
+
+
+class GitBatch:
+    """
+    A git cat-file --batch-check process for resolving refs in the repository at <path>
+    without starting a new git process for each one. The process is started on the first
+    resolve call, so the repository doesn't need to exist when the GitBatch is created.
+
+    While a GitBatch is open (used as a context manager), the commit hash functions in
+    this module use it for the same path.
+    """
+    _open: "WeakValueDictionary[str, GitBatch]" = WeakValueDictionary()
+
+    def __init__(self, path: PathLike):
+        self.path = os.path.abspath(path)
+        self.process: Optional[subprocess.Popen] = None
+        self.lock = Lock()
+
+    @classmethod
+    def get(cls, path: PathLike) -> Optional["GitBatch"]:
+        """Returns the open GitBatch for <path> or None if there isn't one"""
+        return cls._open.get(os.path.abspath(path))
+
+    def resolve(self, ref: str) -> Optional[str]:
+        """Returns the object name <ref> points to, or None if it couldn't be resolved"""
+        with self.lock:
+            try:
+                if self.process is None:
+                    self.process = subprocess.Popen(
+                        [GIT, "-C", self.path, *settings.GIT_OPTIONS, "cat-file", "--batch-check=%(objectname) %(objecttype)"],
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL,
+                        encoding="utf-8",
+                        # A local read-only command, see git_call
+                        close_fds=False,
+                    )
+                self.process.stdin.write(ref + "\n")
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+            except OSError:
+                return None
+
+        # Output is "<ref> missing" for refs that don't exist, and empty if git exited
+        parts = line.split()
+        if len(parts) != 2 or parts[1] == "missing":
+            return None
+        return parts[0]
+
+    def close(self) -> None:
+        if GitBatch._open.get(self.path) is self:
+            del GitBatch._open[self.path]
+        with self.lock:
+            if self.process is not None:
+                try:
+                    self.process.stdin.close()
+                except OSError:
+                    pass
+                self.process.wait()
+                self.process = None
+
+    def __enter__(self) -> "GitBatch":
+        GitBatch._open[self.path] = self
+        return self
+
+    def __exit__(self, etype: Optional[Type[BaseException]], e: Optional[BaseException], tb: Optional[TracebackType]):
+        self.close()
+
+
+@atexit.register
+def _close_git_batches() -> None:
+    for batch in list(GitBatch._open.values()):
+        batch.close()
 
 
 def clone(path: str, remote_url: str, branch: str, *, logger: Logger = default_logger) -> bool:
     Path(path).mkdir(parents=True, exist_ok=True)
 
-    success, logstr = git_call(".", "clone", ["clone", "-b", branch, "--recursive", remote_url, path])
+    # A partial clone fetches the blobs lazily when they are checked out. The commits and trees
+    # are still fetched, so the history stays available for comparing builds
+    filter_args = [f"--filter={settings.GIT_CLONE_FILTER}"] if settings.GIT_CLONE_FILTER else []
+    success, logstr = git_call(".", "clone", ["clone", "-b", branch, "--recursive", f"--jobs={settings.GIT_SUBMODULE_JOBS}", *filter_args, remote_url, path], needs_ssh=True)
     logger.info(logstr)
     return success
 
@@ -44,18 +155,20 @@ def clone(path: str, remote_url: str, branch: str, *, logger: Logger = default_l
 def checkout(path: str, remote_url: str, branch: str, *, logger: Logger = default_logger) -> bool:
     success = True
     # set the path beforehand, and handle logging
-    def git(command: str, cmd: List[str]):
+    def git(command: str, cmd: List[str], needs_ssh: bool = False):
         nonlocal success
         if not success: # dont run the other commands if one fails
             return
-        success, output = git_call(path, command, cmd)
+        success, output = git_call(path, command, cmd, needs_ssh=needs_ssh)
         logger.info(output)
 
-    git("fetch", ["fetch", "origin", branch])
-    git("reset", ["reset", "-q", "--hard", f"origin/{branch}"])
+    git("fetch", ["fetch", "origin", branch], needs_ssh=True)
+    # In a partial clone (GIT_CLONE_FILTER), the reset fetches the missing file contents from the remote
+    git("reset", ["reset", "-q", "--hard", f"origin/{branch}"], needs_ssh=True)
     git("submodule sync", ["submodule", "sync", "--recursive"])
-    git("submodule reset", ["submodule", "foreach", "--recursive", "git", "reset", "-q", "--hard"])
-    git("submodule update", ["submodule", "update", "--init", "--recursive"])
+    # --force discards local changes in the submodules like a reset --hard would, so that
+    # a separate submodule foreach (which starts a shell and git for each submodule) isn't needed
+    git("submodule update", ["submodule", "update", "--init", "--recursive", "--force", f"--jobs={settings.GIT_SUBMODULE_JOBS}"], needs_ssh=True)
 
     return success
 
@@ -71,18 +184,77 @@ def clean(path: str, origin: str, branch: str, exclude_patterns: List[str] = [],
         logger.info(output)
 
     git("clean", ["clean", "-xfd"] + [e for f in exclude_patterns for e in ["-e", f]])
-    git("submodule clean", ["submodule", "foreach", "--recursive", "git", "clean", "-xfd"])
+    # git clean doesn't descend into submodules, so they are cleaned separately. This is skipped
+    # when there are no submodules
+    if success and os.path.exists(os.path.join(path, ".gitmodules")):
+        success = _clean_submodules(path, logger)
+
+    return success
+
+
+def _submodule_paths(path: str) -> Tuple[Optional[str], Optional[List[str]]]:
+    """
+    Gets the checked out submodules (recursively) of the repository at <path>, relative to <path>.
+    Returns (error, paths)-tuple, where either error or paths is None
+    """
+    # The paths are printed by the shell NUL separated, so any path is handled correctly
+    success, output = git_call(
+        path,
+        "submodule foreach",
+        ["submodule", "foreach", "--quiet", "--recursive", "printf '%s\\0' \"$displaypath\""],
+        include_cmd_string=False,
+        merge_stderr=False,
+        local_read=True,
+    )
+    if not success:
+        return output, None
+
+    return None, [p for p in output.split("\0") if p]
+
+
+def _clean_submodules(path: str, logger: Logger) -> bool:
+    """
+    Runs git clean in every submodule of <path>. The submodules are independent repositories
+    (a clean in a parent doesn't touch the nested submodules), so they are cleaned in parallel
+    instead of one at a time with submodule foreach.
+    """
+    error, paths = _submodule_paths(path)
+    if paths is None:
+        logger.info(error)
+        return False
+
+    with ThreadPoolExecutor(max_workers=settings.GIT_SUBMODULE_JOBS) as executor:
+        results = list(executor.map(
+            lambda subpath: git_call(os.path.join(path, subpath), "submodule clean", ["clean", "-xfd"]),
+            paths,
+        ))
+
+    success = True
+    for subpath, (clean_success, output) in zip(paths, results):
+        logger.info(f"Entering '{subpath}'\n{output}")
+        success = success and clean_success
 
     return success
 
 
 def has_remote_url(path: str, remote_url: str) -> bool:
-    success, origin_url = git_call(path, "remote", ["remote", "get-url", "origin"], include_cmd_string=False)
+    success, origin_url = git_call(path, "remote", ["remote", "get-url", "origin"], include_cmd_string=False, merge_stderr=False, local_read=True)
     return remote_url == origin_url.strip()
 
 
 def repo_exists_at(path: PathLike) -> bool:
-    success, true_or_error = git_call(os.fspath(path), "rev-parse", ["rev-parse", "--is-inside-work-tree"], include_cmd_string = False)
+    # Check the common cases without starting git
+    if not os.path.exists(path):
+        return False
+    dotgit = os.path.join(path, ".git")
+    if os.path.isdir(dotgit):
+        return True
+    if os.path.isfile(dotgit):
+        with open(dotgit) as f:
+            if f.read(7) == "gitdir:":
+                return True
+
+    success, true_or_error = git_call(os.fspath(path), "rev-parse", ["rev-parse", "--is-inside-work-tree"], include_cmd_string = False, merge_stderr = False, local_read = True)
     return success and true_or_error.strip() == "true"
 
 
@@ -109,16 +281,58 @@ def get_diff_names(path: PathLike, sha1: str, sha2: Optional[str] = None) -> Tup
     """Gets the changed files between commits <sha1> and <sha2> (or HEAD if None). Returns (error, files)-tuple, where either error or files is None"""
     if sha2 is None:
         sha2 = "HEAD"
-    success, files_or_error = git_call(os.fspath(path), "diff", ["diff", "--name-only", sha1, sha2], include_cmd_string = False)
+    if sha1 == sha2:
+        return None, []
+    # The rename detection of git diff reads file contents, which may need to be fetched in a partial clone
+    success, files_or_error = git_call(os.fspath(path), "diff", ["diff", "--name-only", "-z", sha1, sha2], include_cmd_string = False, needs_ssh = True, merge_stderr = False)
     if success:
-        return None, [f for f in files_or_error.split("\n") if f]
+        # -z separates the names with NULs and stops git from quoting unusual names
+        return None, [f for f in files_or_error.split("\0") if f]
+    else:
+        return files_or_error, None
+
+
+def get_diff_names_between(path: PathLike, commits: List[str]) -> Tuple[Optional[str], Optional[List[str]]]:
+    """
+    Gets the files changed between each consecutive pair of <commits>, and between the first commit and HEAD,
+    using a single git process. The commits must be full hashes. Returns (error, files)-tuple, where either
+    error or files is None.
+    """
+    success, head_or_error = _get_commit_hash(path)
+    if not success:
+        return head_or_error, None
+
+    # diff-tree reads "<commit> <parent>" lines and compares the trees of the two commits on each line
+    commits = [head_or_error.strip(), *commits]
+    # Identical commits have no changes. Commonly nothing has changed since the last build,
+    # in which case git isn't started at all
+    pairs = "".join(f"{sha2} {sha1}\n" for sha1, sha2 in zip(commits[1:], commits) if sha1 != sha2)
+    if not pairs:
+        return None, []
+    success, files_or_error = git_call(
+        os.fspath(path),
+        "diff-tree",
+        ["diff-tree", "--stdin", "-r", "--name-only", "--no-commit-id", "-z"],
+        include_cmd_string = False,
+        input = pairs,
+        merge_stderr = False,
+        local_read = True,
+    )
+    if success:
+        return None, [f for f in files_or_error.split("\0") if f]
     else:
         return files_or_error, None
 
 
 def _get_commit_hash(path: PathLike) -> Tuple[bool, str]:
     """Returns (success, hash_or_error) where the hash has a newline at the end"""
-    return git_call(os.fspath(path), "rev-parse", ["rev-parse", "HEAD"], include_cmd_string = False)
+    batch = GitBatch.get(path)
+    if batch is not None:
+        commit_hash = batch.resolve("HEAD")
+        if commit_hash is not None:
+            return True, commit_hash + "\n"
+
+    return git_call(os.fspath(path), "rev-parse", ["rev-parse", "--verify", "HEAD"], include_cmd_string = False, merge_stderr = False, local_read = True)
 
 
 def get_commit_hash_or_none(path: PathLike) -> Optional[str]:
@@ -135,4 +349,4 @@ def get_commit_hash(path: PathLike) -> str:
 
 
 def get_commit_metadata(path: PathLike) -> Tuple[bool, str]:
-    return git_call(os.fspath(path), "log", ["--no-pager", "log", '--pretty=format:------------\nCommit metadata\n\nHash:\n%H\nSubject:\n%s\nBody:\n%b\nCommitter:\n%ai\n%ae\nAuthor:\n%ci\n%cn\n%ce\n------------\n', "-1"], include_cmd_string=False)
+    return git_call(os.fspath(path), "log", ["--no-pager", "log", '--pretty=format:------------\nCommit metadata\n\nHash:\n%H\nSubject:\n%s\nBody:\n%b\nCommitter:\n%ai\n%ae\nAuthor:\n%ci\n%cn\n%ce\n------------\n', "-1"], include_cmd_string=False, merge_stderr=False, local_read=True)
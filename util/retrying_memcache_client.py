@@ -1,11 +1,45 @@
+from threading import Lock
+from typing import Dict, Tuple
+
 from pymemcache.client import retrying, hash
 from django.core.cache.backends.memcached import PyMemcacheCache
 from django.conf import settings
 
+
+# Default socket timeouts in seconds, can be overridden in the cache OPTIONS
+DEFAULT_CONNECT_TIMEOUT = 0.5
+DEFAULT_TIMEOUT = 0.5
+
+# Clients shared by all RetryingMemcacheClient instances with the same servers and options.
+# Django creates a cache backend instance per thread, so without sharing every thread
+# would open its own connections to every server.
+_clients: Dict[Tuple[Tuple[str, ...], str], retrying.RetryingClient] = {}
+_clients_lock = Lock()
+
+
 class RetryingMemcacheClient(PyMemcacheCache):
     def __init__(self, server, params):
         super().__init__(server, params)
-        self._cache = retrying.RetryingClient(
-            hash.HashClient(self.client_servers, **self._options),
-            **settings.RETRYING_MEMCACHE_CLIENT_OPTIONS
-        )
+        # The client is shared between threads, so it must use a connection pool.
+        # The timeouts make a hung server fail (and be retried) instead of blocking forever.
+        # The connections are opened lazily on first use of each server.
+        options = {
+            "use_pooling": True,
+            "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+            "timeout": DEFAULT_TIMEOUT,
+            **self._options,
+        }
+        key = (tuple(self.client_servers), repr(sorted(options.items())))
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = retrying.RetryingClient(
+                    hash.HashClient(self.client_servers, **options),
+                    **settings.RETRYING_MEMCACHE_CLIENT_OPTIONS
+                )
+                _clients[key] = client
+        self._cache = client
+
+    def close(self, **kwargs):
+        # The shared client keeps its pooled connections open between requests
+        pass
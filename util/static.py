@@ -45,9 +45,13 @@ def symbolic_link(course_config: "CourseConfig"):
     if static_dir is not None:
         static_dir = course_config.path_to(course_config.key, static_dir)
         if course_config.data.unprotected_paths is not Undefined:
+            created_dirs = set()
             for path in course_config.data.unprotected_paths:
-                (dst / path).parent.mkdir(parents=True, exist_ok=True)
-                (dst / path).symlink_to(static_dir / path)
+                link = dst / path
+                if link.parent not in created_dirs:
+                    link.parent.mkdir(parents=True, exist_ok=True)
+                    created_dirs.add(link.parent)
+                link.symlink_to(static_dir / path)
             if id_dst is not None and course_config.data.unprotected_paths:
                 id_dst.symlink_to(dst)
         else:
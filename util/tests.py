@@ -1,9 +1,15 @@
+import os
 import os.path
+import subprocess
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
 from django.conf import settings
 from django.test import TestCase, override_settings
 
-from .git import get_diff_names, git_call
+from .files import copytree
+from . import git
+from .git import checkout, clone, get_diff_names, get_diff_names_between, git_call
 
 
 # commits in the test git dir
@@ -47,6 +53,10 @@ class GitTest(TestCase):
         self.assertTrue(success)
         self.assertRegex(response, "git rev-parse HEAD\n[0-9a-z]{40}\n")
 
+        success, response = git_call(self.git_dir, "nonexistentcommand", ["nonexistentcommand"], include_cmd_string = False, merge_stderr = False)
+        self.assertFalse(success)
+        self.assertEqual(response, "Git nonexistentcommand: returncode: 1\nstdout: \nstderr: git: 'nonexistentcommand' is not a git command. See 'git --help'.\n\n")
+
     def test_diff_names(self) -> None:
         _, changed_files = get_diff_names(self.git_dir, commits["master"][0])
         self.assertIsNotNone(changed_files)
@@ -68,5 +78,110 @@ class GitTest(TestCase):
         self.assertIsNotNone(changed_files)
         self.assertEqual(set(changed_files or []), {"file3"})
 
+        _, changed_files = get_diff_names(self.git_dir, commits["master"][3])
+        self.assertEqual(changed_files, [])
+
         _, changed_files = get_diff_names(self.git_dir, "nonexistentcommit")
         self.assertIsNone(changed_files)
+
+    def test_diff_names_between(self) -> None:
+        _, changed_files = get_diff_names_between(self.git_dir, [commits["master"][2], commits["master"][0]])
+        self.assertIsNotNone(changed_files)
+        self.assertEqual(set(changed_files or []), {"file1", "file2"})
+
+        # Renames are listed as a deletion and an addition
+        _, changed_files = get_diff_names_between(self.git_dir, [commits["otherbranch"][2], commits["master"][2]])
+        self.assertIsNotNone(changed_files)
+        self.assertEqual(set(changed_files or []), {"file2", "file3"})
+
+        # Nothing changed since HEAD, and an update of the same commit adds no changes
+        _, changed_files = get_diff_names_between(self.git_dir, [commits["master"][3], commits["master"][3]])
+        self.assertEqual(changed_files, [])
+
+        _, changed_files = get_diff_names_between(self.git_dir, ["0" * 40])
+        self.assertIsNone(changed_files)
+
+
+@override_settings(
+    GIT_OPTIONS=[],
+    GIT_CLONE_FILTER="blob:none",
+)
+class PartialCloneTest(TestCase):
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+        self.remote = os.path.join(self.tmp, "remote")
+        self.run_git(".", "init", "-q", "-b", "master", self.remote)
+        self.run_git(self.remote, "config", "uploadpack.allowFilter", "true")
+        self.commit("first")
+
+        # The remote is accessed over "ssh" through a script that runs the command locally,
+        # so that fetching only works with the environment that git_call uses for remote calls
+        ssh = os.path.join(self.tmp, "ssh")
+        with open(ssh, "w") as f:
+            # The command is the last argument. GIT_PROTOCOL is inherited like OpenSSH's SendEnv
+            f.write('#!/bin/sh\neval "command=\\${$#}"\nexec sh -c "$command"\n')
+        os.chmod(ssh, 0o755)
+        env = dict(git.git_env, GIT_SSH_COMMAND=ssh, GIT_SSH_VARIANT="ssh")
+        patcher = patch.object(git, "git_env", env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_git(self, path: str, *args: str) -> None:
+        subprocess.run(
+            ["git", "-C", path, "-c", "user.name=test", "-c", "user.email=test@localhost", *args],
+            check=True,
+            capture_output=True,
+        )
+
+    def commit(self, content: str) -> None:
+        with open(os.path.join(self.remote, "file"), "w") as f:
+            f.write(content)
+        self.run_git(self.remote, "add", "file")
+        self.run_git(self.remote, "commit", "-q", "-m", content)
+
+    def test_checkout(self) -> None:
+        path = os.path.join(self.tmp, "clone")
+        remote_url = f"localhost:{self.remote}"
+        self.assertTrue(clone(path, remote_url, "master"))
+
+        self.commit("second")
+        # The reset fetches the content of the new commit from the remote
+        self.assertTrue(checkout(path, remote_url, "master"))
+        with open(os.path.join(path, "file")) as f:
+            self.assertEqual(f.read(), "second")
+
+        _, changed_files = get_diff_names(path, "HEAD~1")
+        self.assertEqual(changed_files, ["file"])
+
+
+class FilesTest(TestCase):
+    def test_copytree(self) -> None:
+        with TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "src")
+            os.makedirs(os.path.join(src, "dir"))
+            with open(os.path.join(src, "file"), "w") as f:
+                f.write("content")
+            os.chmod(os.path.join(src, "file"), 0o640)
+            os.link(os.path.join(src, "file"), os.path.join(src, "dir", "link"))
+            os.symlink("../file", os.path.join(src, "dir", "symlink"))
+
+            dst = os.path.join(tmp, "dst")
+            copytree(src, dst)
+
+            with open(os.path.join(dst, "file")) as f:
+                self.assertEqual(f.read(), "content")
+            stat = os.stat(os.path.join(dst, "file"))
+            self.assertEqual(stat.st_mode & 0o777, 0o640)
+            self.assertEqual(stat.st_mtime_ns, os.stat(os.path.join(src, "file")).st_mtime_ns)
+            self.assertTrue(os.path.samefile(os.path.join(dst, "file"), os.path.join(dst, "dir", "link")))
+            self.assertFalse(os.path.samefile(os.path.join(dst, "file"), os.path.join(src, "file")))
+            self.assertEqual(os.readlink(os.path.join(dst, "dir", "symlink")), "../file")
+
+            linked = os.path.join(tmp, "linked")
+            copytree(src, linked, link_files=True)
+            self.assertTrue(os.path.samefile(os.path.join(linked, "file"), os.path.join(src, "file")))
+            self.assertTrue(os.path.samefile(os.path.join(linked, "dir", "link"), os.path.join(src, "file")))
+            self.assertEqual(os.readlink(os.path.join(linked, "dir", "symlink")), "../file")